@@ -0,0 +1,220 @@
+"""
+The ingest pipeline on asyncio, as an alternative to the threads of pipeline.py (see main.py --asyncio):
+
+    MQTT --ingest--> writer --state_q--> state --> display
+
+Each stage is a task on one event loop, and they're connected by bounded queues. The MQTT client runs on the loop too, driven by its socket (see Monitor.start_async), so adding an input doesn't add a thread.
+
+When a queue is full:
+    ingest: MQTT can't be paused, so an event is dropped and counted. By default the oldest, or with ingest_policy="drop_newest", the new one.
+    state_q: the writer waits. That holds up ingest, so its queue fills up instead of memory.
+    display: nothing queues. The state stage just flags a change, and any number of changes coalesce into one render (see Display.schedule).
+
+Blocking work runs in executors, off the loop: database writes and checkpoints on one thread, cache saves and report rendering on another. State and Display share an asyncio.Lock, so a render never sees a half-applied batch.
+
+On SIGINT or SIGTERM, MQTT is disconnected, then everything already received is written, checkpointed and folded in, and the reports are flushed.
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import signal
+import time
+
+import metrics
+import pipeline
+from pipeline import STOP, Stage, QUEUE_WAIT_SECONDS
+
+POLICIES = ["drop_oldest", "drop_newest"]
+
+DROPPED = metrics.counter("pipeline_dropped_total", "Events dropped because the ingest queue was full")
+
+class AsyncPipeline(pipeline.BasePipeline):
+    def __init__(self, monitor, db, state, display, batch_size=100, ingest_size=10000, ingest_policy="drop_oldest", state_size=100,
+            stats_interval=None, metrics_path=None, metrics_interval=60):
+        assert ingest_policy in POLICIES
+        super().__init__(monitor, db, state, display, batch_size, stats_interval, metrics_path, metrics_interval)
+        self.ingest_size = ingest_size # Events
+        self.ingest_policy = ingest_policy
+        self.state_size = state_size # Batches
+
+        self.ingest = asyncio.Queue(ingest_size)
+        self.state_q = asyncio.Queue(state_size)
+        self.stages = [
+            Stage("writer", self.ingest),
+            Stage("state", self.state_q),
+            Stage("display"),
+        ]
+        self.db_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="db")
+        self.render_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="render")
+        self.dropped = 0
+
+    def run(self):
+        # Run until SIGINT or SIGTERM, or until a stage fails
+        asyncio.run(self.main())
+        if self.error is not None:
+            raise RuntimeError("pipeline stage failed") from self.error
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock() # Guards state and display
+        self.changed = asyncio.Event() # The state changed since the display last looked
+        self.state_done = False
+        self.pending = [] # Events folded into the state, but not yet shown in the reports
+        self.stop_requested = asyncio.Event()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop_requested.set)
+        self.monitor.start_async(loop, self.deliver)
+        stages = [asyncio.create_task(self.run_stage(run())) for run in (self.run_writer, self.run_state, self.run_display)]
+        helpers = [asyncio.create_task(self.run_mqtt()), asyncio.create_task(self.run_periodic())]
+        try:
+            stop_requested = asyncio.create_task(self.stop_requested.wait())
+            await asyncio.wait(stages + [stop_requested], return_when=asyncio.FIRST_COMPLETED)
+            stop_requested.cancel()
+
+            # Stop receiving, then finish everything already received
+            self.monitor.disconnect()
+            for helper in helpers:
+                helper.cancel()
+            if self.error is None:
+                await self.ingest.put(STOP)
+            else:
+                for stage in stages:
+                    stage.cancel() # A stage died, so STOP may never make it down the pipeline
+            await asyncio.gather(*stages, *helpers, return_exceptions=True)
+            if self.metrics_path:
+                self.export_metrics()
+        finally:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            self.db_executor.shutdown()
+            self.render_executor.shutdown()
+
+    async def run_stage(self, coroutine):
+        try:
+            await coroutine
+        except Exception as e:
+            self.error = e
+            self.stop_requested.set()
+            raise
+
+    def deliver(self, event):
+        # Called on the loop for each MQTT event. Never blocks: a full queue drops an event instead.
+        if self.ingest.full():
+            self.dropped += 1
+            DROPPED.inc()
+            if self.ingest_policy == "drop_newest":
+                return
+            self.ingest.get_nowait()
+        self.ingest.put_nowait(event)
+
+    def in_db(self, f, *args):
+        return asyncio.get_running_loop().run_in_executor(self.db_executor, f, *args)
+
+    def in_render(self, f, *args):
+        return asyncio.get_running_loop().run_in_executor(self.render_executor, f, *args)
+
+    def stats(self):
+        stats = super().stats()
+        stats["writer"]["dropped"] = self.dropped
+        return stats
+
+    async def run_mqtt(self):
+        while True:
+            await self.monitor.maintain()
+            await asyncio.sleep(1)
+
+    async def run_periodic(self):
+        next_stats = next_metrics = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            if self.stats_interval and now >= next_stats + self.stats_interval:
+                self.log_stats()
+                next_stats = now
+            if self.metrics_path and now >= next_metrics + self.metrics_interval:
+                await self.in_render(self.export_metrics)
+                next_metrics = now
+
+    @staticmethod
+    async def get_batch(q, batch_size, timeout=None):
+        # Wait for one item, then take whatever else is waiting, up to batch_size
+        # Returns an empty batch on timeout
+        try:
+            batch = [await asyncio.wait_for(q.get(), timeout)]
+        except asyncio.TimeoutError:
+            return [], False
+        while len(batch) < batch_size and batch[-1] is not STOP:
+            try:
+                batch.append(q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        stop = batch[-1] is STOP
+        if stop:
+            batch.pop()
+        return batch, stop
+
+    async def run_writer(self):
+        stage = self.stages[0]
+        while True:
+            batch, stop = await self.get_batch(self.ingest, self.batch_size, timeout=self.db.checkpoint_due())
+            now = datetime.datetime.now(datetime.UTC)
+            for _, ts, _ in batch:
+                QUEUE_WAIT_SECONDS.observe((now - ts).total_seconds())
+            started = time.monotonic()
+            await self.in_db(self.db.write_many, batch) # Also checkpoints, if one is due
+            if stop:
+                await self.in_db(self.db.checkpoint)
+
+            stage.done(batch, started)
+            if batch:
+                await self.state_q.put(batch) # Waits if the state stage is behind
+            if stop:
+                await self.state_q.put(STOP)
+                return
+
+    async def run_state(self):
+        stage = self.stages[1]
+        while True:
+            batch = await self.state_q.get()
+            if batch is STOP:
+                self.state_done = True
+                self.changed.set()
+                return
+            started = time.monotonic()
+            async with self.lock:
+                for event in batch:
+                    self.display.log(event)
+                    self.state.update(*event)
+                await self.in_render(self.state.maybe_save)
+            stage.done(batch, started)
+            self.pending.extend(batch)
+            self.changed.set()
+
+    async def run_display(self):
+        stage = self.stages[2]
+        while True:
+            try:
+                await asyncio.wait_for(self.changed.wait(), self.display.wait_time())
+            except asyncio.TimeoutError:
+                pass
+            stop = self.state_done
+            self.changed.clear()
+            pending, self.pending = self.pending, []
+
+            started = time.monotonic()
+            async with self.lock:
+                if pending:
+                    await self.in_render(self.display.schedule, self.state)
+                else:
+                    await self.in_render(self.display.flush_due, self.state)
+                if stop:
+                    await self.in_render(self.display.flush, self.state)
+                rendered = self.display.wait_time() is None
+            if rendered and pending:
+                stage.done(pending, started)
+            elif pending:
+                self.pending = pending + self.pending # Count them once they're shown
+            if stop:
+                return
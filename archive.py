@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Compact archives of the temperature database, for backups and off-box copies.
+
+    ./archive.py export temps.db temps.archive [--lzma]
+    ./archive.py import temps.archive temps.db
+    ./archive.py list temps.archive
+    ./archive.py show temps.archive SENSOR YYYY-MM
+
+temps.db is mostly preallocated zeros. An archive holds only the records, one chunk per sensor per (UTC) month, so each month can be read without expanding the rest. Importing an archive rebuilds a byte-identical temps.db, plus its index and rollup tiers.
+
+The format of an archive is:
+
+    MAGIC
+    chunk, chunk, ...
+    index (zlib-compressed JSON)
+    index offset (8 bytes, big-endian), index length (8 bytes), MAGIC
+
+The index holds the version, the codec ("zlib" or "lzma"), each sensor's header (the JSON lines of database.py, without the zero padding), and a list of chunks, as [sensor, month, rows, offset, length]. Months are numbered from the month of EPOCH.
+
+A chunk is columnar. It is the concatenation of these columns, each delta-encoded (the first value is stored as-is, then the difference from the previous value), then compressed with the codec:
+    the row number, counted from the start of the month (int16)
+    each field of the record, in order (int16 for 1-byte fields, int32 for 2-byte fields)
+
+Rows are found through the occupancy index, plus a scan of each sensor's rows after the newest one in the index, up to now. So rows written after the writer's last checkpoint are exported too, including any a crash left behind. Export is safe while the service is running.
+"""
+
+import argparse
+import datetime
+import json
+import lzma
+import mmap
+import numpy
+import os
+import os.path
+import struct
+import sys
+import zlib
+
+import database
+from database import METADATA_LENGTH, RECORD_DTYPE, SENSOR_LENGTH
+from dates import EPOCH, SENSOR_ROWS, ts2rownum, rownum2ts
+
+MAGIC = b"TEMPARC1"
+VERSION = 1
+FOOTER = struct.Struct(">QQ8s")
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+COLUMNS = [("rownum", numpy.dtype("<i2"))] + [
+    (name, numpy.dtype("<i2") if RECORD_DTYPE[name].itemsize == 1 else numpy.dtype("<i4"))
+    for name in RECORD_DTYPE.names
+]
+
+def month2ts(month):
+    # The start of a month, numbered from the month of EPOCH
+    return EPOCH.replace(year=EPOCH.year + month // 12, month=month % 12 + 1)
+
+def parse_month(text):
+    # "YYYY-MM" to a month number
+    date = datetime.datetime.strptime(text, "%Y-%m")
+    return (date.year - EPOCH.year)*12 + date.month - EPOCH.month
+
+MONTH_STARTS = [] # The first row of each month, plus the end of the last one
+for month in range(64*12 + 1):
+    MONTH_STARTS.append(min(ts2rownum(month2ts(month)), SENSOR_ROWS))
+MONTH_STARTS = numpy.array(MONTH_STARTS, dtype=numpy.int64)
+
+def encode(rownums, records, codec):
+    # Compress the rows of one month (rownums counted from the start of the month), see the format above
+    columns = [rownums] + [records[name] for name in RECORD_DTYPE.names]
+    data = b"".join(
+        numpy.diff(column.astype(numpy.int64), prepend=0).astype(dtype).tobytes()
+        for column, (_, dtype) in zip(columns, COLUMNS)
+    )
+    return CODECS[codec][0](data)
+
+def decode(chunk, rows, month, codec):
+    # The (rownums, records) of one month
+    data = CODECS[codec][1](chunk)
+    columns, offset = [], 0
+    for _, dtype in COLUMNS:
+        deltas = numpy.frombuffer(data, dtype=dtype, count=rows, offset=offset)
+        columns.append(numpy.cumsum(deltas, dtype=numpy.int64))
+        offset += rows * dtype.itemsize
+    assert offset == len(data), "corrupt chunk"
+    records = numpy.zeros(rows, dtype=RECORD_DTYPE)
+    for name, column in zip(RECORD_DTYPE.names, columns[1:]):
+        records[name] = column
+    return columns[0] + MONTH_STARTS[month], records
+
+class Archive():
+    """A read-only archive, see above"""
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        assert self.f.read(len(MAGIC)) == MAGIC, "{} is not an archive".format(path)
+        self.f.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        assert magic == MAGIC, "{} is truncated".format(path)
+        self.f.seek(index_offset)
+        index = json.loads(zlib.decompress(self.f.read(index_length)))
+        assert index["version"] == VERSION
+        self.codec = index["codec"]
+        self.headers = index["headers"]
+        self.chunks = {(sensor, month): (rows, offset, length) for sensor, month, rows, offset, length in index["chunks"]}
+
+    def count_sensors(self):
+        return len(self.headers)
+
+    def sensors(self):
+        # Metadata for every sensor, as in Database.metadata
+        return [json.loads(header.split("\n")[1])[1] for header in self.headers]
+
+    def months(self, sensor):
+        # The months with data for a sensor, ascending
+        return sorted(month for s, month in self.chunks if s == sensor)
+
+    def read(self, sensor, month):
+        # The (rownums, records) of a sensor in one month. Only that month's chunk is read.
+        if (sensor, month) not in self.chunks:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=RECORD_DTYPE)
+        rows, offset, length = self.chunks[(sensor, month)]
+        self.f.seek(offset)
+        return decode(self.f.read(length), rows, month, self.codec)
+
+    def close(self):
+        self.f.close()
+
+def split(months):
+    # Yield (month, start, end) for each run of equal, sorted months
+    starts = numpy.flatnonzero(numpy.diff(months, prepend=-1))
+    for start, end in zip(starts.tolist(), numpy.append(starts[1:], len(months)).tolist()):
+        yield int(months[start]), start, end
+
+def read_sensor(db, sensor):
+    # Every record of a sensor which has a non-zero byte (not just the version, so the import is identical)
+    # Past the newest row in the index, scan without it, as Database.load_index does: the writer may have crashed before its checkpoint
+    occupancy = db.occupancy[sensor]
+    now = ts2rownum(datetime.datetime.now(datetime.UTC))
+    all_rownums, all_records = [], []
+    for range_start, range_end in list(occupancy.ranges()) + [(occupancy.hwm + 1, now + 1)]:
+        records = db.records(sensor, range_start, range_end)
+        rownums = numpy.flatnonzero(records.view(numpy.uint8).reshape(-1, RECORD_DTYPE.itemsize).any(axis=1))
+        all_rownums.append(rownums + range_start)
+        all_records.append(records[rownums])
+    return numpy.concatenate(all_rownums), numpy.concatenate(all_records)
+
+def export_archive(db_path, path, codec="zlib"):
+    db = database.Database(None, db_path, readonly=True)
+    headers, chunks = [], []
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        for sensor in range(db.count_sensors()):
+            headers.append(db.mm[SENSOR_LENGTH*sensor:SENSOR_LENGTH*sensor + METADATA_LENGTH].rstrip(b"\0").decode("utf8"))
+            rownums, records = read_sensor(db, sensor)
+            months = numpy.searchsorted(MONTH_STARTS, rownums, side="right") - 1
+            for month, start, end in split(months):
+                chunk = encode(rownums[start:end] - MONTH_STARTS[month], records[start:end], codec)
+                chunks.append([sensor, month, end - start, f.tell(), len(chunk)])
+                f.write(chunk)
+        index_offset = f.tell()
+        index = zlib.compress(json.dumps({
+            "version": VERSION,
+            "codec": codec,
+            "headers": headers,
+            "chunks": chunks,
+        }).encode("utf8"), 9)
+        f.write(index)
+        f.write(FOOTER.pack(index_offset, len(index), MAGIC))
+    db.close()
+
+def import_archive(path, db_path):
+    # Rebuild a database from an archive. db_path must not exist yet.
+    assert not os.path.exists(db_path), "{} already exists".format(db_path)
+    archive = Archive(path)
+    with open(db_path, "x+b") as f:
+        f.truncate(archive.count_sensors() * SENSOR_LENGTH) # Sparse, like a new database
+        for sensor, header in enumerate(archive.headers):
+            f.seek(SENSOR_LENGTH*sensor)
+            f.write(header.encode("utf8"))
+        f.flush()
+        with mmap.mmap(f.fileno(), 0) as mm:
+            for (sensor, month) in sorted(archive.chunks):
+                rownums, records = archive.read(sensor, month)
+                view = numpy.frombuffer(mm, dtype=RECORD_DTYPE, count=SENSOR_ROWS, offset=SENSOR_LENGTH*sensor + METADATA_LENGTH)
+                view[rownums] = records
+                del view
+            mm.flush()
+    archive.close()
+
+    # Opening the database builds its index and rollup tiers
+    database.Database(archive.sensors(), db_path).close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and import compact archives of the temperature database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("export", help="write an archive of a database")
+    p.add_argument("db")
+    p.add_argument("archive")
+    p.add_argument("--lzma", action="store_const", const="lzma", default="zlib", dest="codec", help="compress with lzma (smaller, slower) rather than zlib")
+
+    p = subparsers.add_parser("import", help="rebuild a database from an archive")
+    p.add_argument("archive")
+    p.add_argument("db")
+
+    p = subparsers.add_parser("list", help="list the months in an archive")
+    p.add_argument("archive")
+
+    p = subparsers.add_parser("show", help="print one month of one sensor")
+    p.add_argument("archive")
+    p.add_argument("sensor", type=int)
+    p.add_argument("month", help="YYYY-MM")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_archive(args.db, args.archive, args.codec)
+        print("{}: {:,} bytes".format(args.archive, os.path.getsize(args.archive)), file=sys.stderr)
+    elif args.command == "import":
+        import_archive(args.archive, args.db)
+    elif args.command == "list":
+        archive = Archive(args.archive)
+        for sensor, metadata in enumerate(archive.sensors()):
+            months = archive.months(sensor)
+            rows = sum(archive.chunks[(sensor, month)][0] for month in months)
+            span = "{} to {}".format(month2ts(months[0]).strftime("%Y-%m"), month2ts(months[-1]).strftime("%Y-%m")) if months else "empty"
+            print("{: >3} {: <35} {: >9,} rows, {}".format(sensor, metadata["human_readable"], rows, span))
+    elif args.command == "show":
+        archive = Archive(args.archive)
+        rownums, records = archive.read(args.sensor, parse_month(args.month))
+        for rownum, record in zip(rownums.tolist(), records.tolist()):
+            print(rownum2ts(rownum).isoformat(), *record)
+
+if __name__ == "__main__":
+    main()
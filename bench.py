@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the hot paths.
+
+    ./bench.py read_all [--db PATH] [--days N] [--repeat N]
+    ./bench.py load [--db PATH] [--workers N] [--repeat N]
+    ./bench.py display [--db PATH] [--repeat N]
+    ./bench.py monitor [--payloads FILE] [--count N]
+    ./bench.py pipeline [--sensors N] [--rate R] [--duration S] [--burst N] [--burst-interval S] [--payloads FILE] [--asyncio]
+        [--min-interval S] [--max-latency S]
+    ./bench.py history [BENCHMARK]
+
+read_all: Database.read_all over the last N days (default: everything), reporting records/second.
+load: State.load_from_db (or with --workers N, load_from_db_parallel), rebuilding the summary without a cache, reporting rows/second.
+display: Display.update from scratch, as on boot, reporting updates/second.
+monitor: decode MQTT messages with Monitor.message2record, single-threaded, and report messages/second.
+    Payloads are replayed from FILE, as written by Monitor(record_path=FILE): one JSON object per line, with "topic" and "payload". Without FILE, typical zigbee2mqtt payloads are made up.
+pipeline: a load test of the whole service, as main.py runs it, against a scratch database and report directory. MQTT is replaced by a replay of messages (from FILE, or made up for N sensors: the real ones, then synthetic ones) into Monitor.on_message: R messages/second for S seconds, plus N more at once every S seconds, as when every sensor reports together. Reports end-to-end latency, from receipt of each message until it's in the report files, and the sustained throughput.
+    Under steady traffic, latency is mostly how long Display holds back an update (see --min-interval and --max-latency, which default to what main.py uses). With --asyncio, runs the asyncio pipeline instead of the threaded one. If the replay can't keep up with the rate, or the asyncio pipeline drops messages, that's reported too.
+
+The database benchmarks use a synthetic database (see generate.py), which is generated at PATH if it doesn't exist yet. Each benchmark also reports latency percentiles (per repeat, or per message for monitor) and the peak RSS of the process, so run one benchmark per process.
+
+Results are appended to bench_results.jsonl (see --results), along with the date and git commit. history prints them, oldest first, so a change in performance can be tracked down.
+"""
+
+import argparse
+import datetime
+import json
+import numpy
+import os
+import os.path
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import aiopipeline
+import database
+import display
+import generate
+import main
+import monitor
+import pipeline
+import state
+
+PERCENTILES = [50, 90, 99, 100]
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Linux reports KiB
+
+def report(args, name, items, unit, elapsed, latencies, params={}):
+    # Print a benchmark's results, and append them to the results file
+    latencies = numpy.percentile(latencies, PERCENTILES).tolist()
+    result = {
+        "date": datetime.datetime.now(datetime.UTC).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "benchmark": name,
+        "params": params,
+        "items": items,
+        "unit": unit,
+        "seconds": elapsed,
+        "throughput": items / elapsed,
+        "latency": dict(zip(("p{}".format(p) for p in PERCENTILES), latencies)),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print("{}: {:,} {} in {:.3f}s, {:,.0f} {}/second, latency {}, peak RSS {:.0f}MB".format(
+        name, items, unit, elapsed, result["throughput"], unit, format_latency(result["latency"]), result["peak_rss_mb"]))
+    if args.results:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+def format_latency(latency):
+    return " ".join("{}={}".format(p, format_seconds(seconds)) for p, seconds in latency.items())
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return "{:.1f}us".format(seconds * 1e6)
+    elif seconds < 1:
+        return "{:.1f}ms".format(seconds * 1e3)
+    return "{:.2f}s".format(seconds)
+
+def open_db(args):
+    if not os.path.exists(args.db):
+        # In another process, so generating doesn't count towards peak RSS
+        print("Generating {} (1 year of readings)...".format(args.db), file=sys.stderr)
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate.py"), args.db], check=True)
+    return database.Database(None, args.db, readonly=True)
+
+def synthetic_payloads(sensors, count=1000, seed=0):
+    # Payloads in the shape zigbee2mqtt sends for the temperature sensors
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        sensor = rnd.choice(sensors)
+        payload = {
+            "battery": rnd.randrange(0, 101),
+            "humidity": round(rnd.uniform(20, 80), 2),
+            "linkquality": rnd.randrange(0, 256),
+            "temperature": round(rnd.uniform(-20, 40), 2),
+            "voltage": rnd.randrange(2500, 3200),
+        }
+        messages.append({"topic": sensor["mqtt_topic"], "payload": json.dumps(payload)})
+    return messages
+
+def load_payloads(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def bench_read_all(args):
+    db = open_db(args)
+    start = datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=args.days) if args.days else None
+    latencies, items = [], 0
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        items = sum(1 for _ in db.read_all(start))
+        latencies.append(time.perf_counter() - started)
+    report(args, "read_all", items * args.repeat, "records", sum(latencies), latencies, {"db": args.db, "days": args.days})
+    db.close()
+
+def bench_load(args):
+    db = open_db(args)
+    items = sum(len(db.read_arrays(sensor)[0]) for sensor in range(db.count_sensors()))
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "cache")
+        for _ in range(args.repeat):
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            s = state.State(db, path=cache_path, workers=args.workers)
+            latencies.append(s.timings["rebuild"])
+    report(args, "load", items * args.repeat, "rows", sum(latencies), latencies, {"db": args.db, "workers": args.workers})
+    db.close()
+
+def bench_display(args):
+    db = open_db(args)
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        s = state.State(db, path=os.path.join(tmp, "cache"))
+        for _ in range(args.repeat):
+            d = display.Display(s.sensors(), report_dir=tmp, report_name="house-temp.{unit}.txt")
+            started = time.perf_counter()
+            d.update(s)
+            latencies.append(time.perf_counter() - started)
+    report(args, "display", args.repeat, "updates", sum(latencies), latencies, {"db": args.db})
+    db.close()
+
+def bench_monitor(args):
+    sensors = main.SENSORS
+    recorded = load_payloads(args.payloads) if args.payloads else synthetic_payloads(sensors)
+    messages = [types.SimpleNamespace(topic=m["topic"], payload=m["payload"].encode('utf8')) for m in recorded]
+    m = monitor.Monitor(sensors)
+
+    decoded = 0
+    latencies = numpy.zeros(args.count)
+    clock = time.perf_counter
+    start = clock()
+    for i in range(args.count):
+        started = clock()
+        if m.message2record(messages[i % len(messages)]) is not None:
+            decoded += 1
+        latencies[i] = clock() - started
+    elapsed = time.perf_counter() - start
+
+    print("monitor: {} JSON, {} of {} decoded".format(monitor.json_loads.__module__, decoded, args.count))
+    report(args, "monitor", args.count, "messages", elapsed, latencies,
+        {"payloads": args.payloads, "json": monitor.json_loads.__module__})
+
+class ReplayMonitor(monitor.Monitor):
+    """
+    Stands in for MQTT: a thread hands messages to on_message, as paho would, on a schedule.
+
+    rate messages/second for duration seconds, plus burst messages at once every burst_interval seconds. Messages are taken from messages in order, cycling.
+    """
+    def __init__(self, sensors, messages, rate, duration, burst=0, burst_interval=None):
+        super().__init__(sensors)
+        self.messages = messages
+        self.rate = rate
+        self.duration = duration
+        self.burst = burst
+        self.burst_interval = burst_interval
+        self.sent = 0
+        self.behind = 0.0 # The most seconds the replay fell behind its schedule
+        self.finished = None # Called from the replay thread, once everything is sent
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.replay, name="replay")
+
+    def start_background(self):
+        self.receive = lambda message: self.on_message(None, None, message)
+        self.thread.start()
+
+    def start_async(self, loop, deliver):
+        # on_message runs on the event loop, as it does with MQTT
+        self.deliver = deliver
+        self.loop = loop
+        self.receive = lambda message: loop.call_soon_threadsafe(self.on_message, None, None, message)
+        self.thread.start()
+
+    async def maintain(self):
+        pass
+
+    def schedule(self):
+        # (seconds from the start, messages to send), in order
+        sends = [(i / self.rate, 1) for i in range(int(self.rate * self.duration))]
+        if self.burst and self.burst_interval:
+            sends += [(t, self.burst) for t in numpy.arange(self.burst_interval, self.duration, self.burst_interval).tolist()]
+        return sorted(sends)
+
+    def replay(self):
+        start = time.monotonic()
+        for due, count in self.schedule():
+            delay = start + due - time.monotonic()
+            if delay > 0:
+                if self.stopped.wait(delay):
+                    break
+            else:
+                self.behind = max(self.behind, -delay)
+            for _ in range(count):
+                self.receive(self.messages[self.sent % len(self.messages)])
+                self.sent += 1
+        if self.finished:
+            self.finished()
+
+    def disconnect(self):
+        self.stopped.set()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread.ident is not None:
+            self.thread.join()
+
+def bench_pipeline(args):
+    sensors = generate.make_sensors(args.sensors)
+    recorded = load_payloads(args.payloads) if args.payloads else synthetic_payloads(sensors, count=max(1000, 10*len(sensors)))
+    messages = [types.SimpleNamespace(topic=m["topic"], payload=m["payload"].encode('utf8')) for m in recorded]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = database.Database(sensors, os.path.join(tmp, "temps.db"), checkpoint_interval=60)
+        s = state.State(db, path=os.path.join(tmp, "temps.db.cache"))
+        d = display.Display(s.sensors(), report_dir=tmp, report_name="house-temp.{unit}.txt", log_events=False, renderers=main.make_renderers(),
+            min_interval=args.min_interval, max_latency=args.max_latency)
+        d.update(s)
+        m = ReplayMonitor(s.sensors(), messages, args.rate, args.duration, args.burst, args.burst_interval)
+        if args.asyncio:
+            p = aiopipeline.AsyncPipeline(m, db, s, d)
+            m.finished = lambda: m.loop.call_soon_threadsafe(p.stop_requested.set)
+        else:
+            p = pipeline.Pipeline(m, db, s, d)
+        shown = p.stages[-1]
+        shown.latencies = []
+
+        started = time.perf_counter()
+        try:
+            if args.asyncio:
+                p.run()
+            else:
+                p.start()
+                m.start_background()
+                m.thread.join()
+                p.stop()
+        finally:
+            m.close()
+        elapsed = time.perf_counter() - started
+        p.log_stats()
+        s.close()
+        db.close()
+        d.close()
+    if p.error is not None:
+        raise RuntimeError("pipeline stage failed") from p.error
+
+    print("pipeline: {:,} sent, {:,} shown, {:,} dropped, replay fell behind by up to {}".format(
+        m.sent, shown.events, getattr(p, "dropped", 0), format_seconds(m.behind)))
+    report(args, "pipeline", shown.events, "messages", elapsed, shown.latencies, {
+        "sensors": args.sensors, "rate": args.rate, "duration": args.duration, "burst": args.burst,
+        "burst_interval": args.burst_interval, "payloads": args.payloads, "asyncio": args.asyncio,
+        "min_interval": args.min_interval, "max_latency": args.max_latency,
+    })
+
+def show_history(args):
+    with open(args.results) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    for result in results:
+        if args.name and result["benchmark"] != args.name:
+            continue
+        print("{}  {: <8} {: <9} {:>14,.0f} {}/s  {}  {:.0f}MB  {}".format(
+            result["date"], result["commit"] or "-", result["benchmark"], result["throughput"], result["unit"],
+            format_latency(result["latency"]), result["peak_rss_mb"], json.dumps(result["params"])))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths")
+    parser.add_argument("--results", default="bench_results.jsonl", help="file to append results to (default: %(default)s, empty to not record)")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("read_all", help="Database.read_all")
+    p.add_argument("--db", default="bench.db", help="synthetic database, generated if missing (default: %(default)s)")
+    p.add_argument("--days", type=float, help="only read the last DAYS days")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_read_all)
+
+    p = subparsers.add_parser("load", help="State.load_from_db")
+    p.add_argument("--db", default="bench.db", help="synthetic database, generated if missing (default: %(default)s)")
+    p.add_argument("--workers", type=int, default=1, help="worker processes (default: %(default)s)")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_load)
+
+    p = subparsers.add_parser("display", help="Display.update")
+    p.add_argument("--db", default="bench.db", help="synthetic database, generated if missing (default: %(default)s)")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_display)
+
+    p = subparsers.add_parser("monitor", help="Monitor.message2record")
+    p.add_argument("--payloads", help="recorded payloads (JSON lines of topic, payload)")
+    p.add_argument("--count", type=int, default=200_000)
+    p.set_defaults(func=bench_monitor)
+
+    p = subparsers.add_parser("pipeline", help="load test the whole service")
+    p.add_argument("--sensors", type=int, default=50, help="sensors, at least the {} real ones the reports show (default: %(default)s)".format(len(main.SENSORS)))
+    p.add_argument("--rate", type=float, default=100, help="messages per second (default: %(default)s)")
+    p.add_argument("--duration", type=float, default=30, help="seconds to send for (default: %(default)s)")
+    p.add_argument("--burst", type=int, default=0, help="extra messages sent at once, every --burst-interval seconds")
+    p.add_argument("--burst-interval", type=float, default=10, help="(default: %(default)s)")
+    p.add_argument("--payloads", help="recorded payloads (JSON lines of topic, payload), rather than synthetic ones")
+    p.add_argument("--asyncio", action="store_true", help="run the asyncio pipeline, rather than threads")
+    p.add_argument("--min-interval", type=float, default=5, help="seconds of quiet before the reports are updated (default: %(default)s)")
+    p.add_argument("--max-latency", type=float, default=30, help="most seconds an update is held back (default: %(default)s)")
+    p.set_defaults(func=bench_pipeline)
+
+    p = subparsers.add_parser("history", help="show recorded results")
+    p.add_argument("name", nargs="?", help="only this benchmark")
+    p.set_defaults(func=show_history)
+
+    args = parser.parse_args()
+    if args.benchmark == "pipeline" and args.sensors < len(main.SENSORS):
+        parser.error("--sensors must be at least {}, since the reports show the real sensors".format(len(main.SENSORS)))
+    args.func(args)
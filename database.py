@@ -23,38 +23,188 @@ Version is always 1.
 Voltage is in unknown integer units.
 
 An all-zero record indicates no data.
+
+Which parts of each sensor's records hold data is tracked in a sidecar index file (temps.db.index), so scans can skip the empty preallocated rows. See Occupancy.
+
+Hourly, daily and monthly rollups are kept in more files alongside, see tiers.py.
+
+Any number of other processes may open the database with readonly=True while the service writes to it. Readers never share a file offset with the writer (they use the mmap, or pread), and only see rows up to the last checkpoint. See refresh() and latest_rownum().
+
+Besides the generator API, the record area of each sensor can be viewed without copying as a structured numpy array (RECORD_DTYPE), backed by an mmap of the file.
 """
 
-import io
+import bisect
+import heapq
 import json
 import math
+import metrics
+import mmap
+import numpy
 import os.path
 import datetime
+import time
+import tiers
+
+from dates import EPOCH, ROW_SECONDS, SENSOR_ROWS, ts2rownum, rownum2ts
 
 SENSOR_LENGTH = 67_376_800
 METADATA_LENGTH = 100_000 # Allocated space for json metadata (rest filled with zeros)
-SENSOR_ROWS = 64 * 365 * 24 * int(60/5)
-EPOCH = datetime.datetime(2024, 1, 1, 0, 0, 0, tzinfo=datetime.UTC)
+CHUNK_ROWS = 1 << 16 # Rows decoded at a time by the generator API
+BLOCK_ROWS = 2048 # Granularity of the occupancy index, about a week. Divides SENSOR_ROWS.
+INDEX_VERSION = 1
+
+# numpy layout of one "!BBhhHBB" record
+RECORD_DTYPE = numpy.dtype([
+    ("version", "u1"),
+    ("row_id", "u1"),
+    ("humid", ">i2"),
+    ("temp", ">i2"),
+    ("volt", ">u2"),
+    ("linkquality", "u1"),
+    ("batt", "u1"),
+])
+assert RECORD_DTYPE.itemsize == 10
+
+WRITE_SECONDS = {op: metrics.histogram("database_write_seconds", "Time to write records, including any checkpoint which comes due", op=op) for op in ["write_ts", "write_many"]}
+CHECKPOINT_SECONDS = metrics.histogram("database_checkpoint_seconds", "Time to commit written records, rollups and the index")
+ROWS_WRITTEN = metrics.counter("database_rows_written_total", "Rows written to the database")
+WRITES = metrics.counter("database_writes_total", "Write calls made to the database file")
+
+def nonempty(records):
+    # Mask of the records which hold data. Any real record has version 1.
+    return records["version"] != 0
+
+def rownums2ts(rownums):
+    # Vectorized rownum2ts, as numpy datetime64 (UTC)
+    rownums = numpy.asarray(rownums, dtype=numpy.int64)
+    return numpy.datetime64(EPOCH.replace(tzinfo=None), "s") + rownums * numpy.timedelta64(ROW_SECONDS, "s")
+
+class Occupancy():
+    """
+    Which rows of one sensor may hold data.
+
+    Rows are grouped into blocks of BLOCK_ROWS. Blocks holding any data are kept as sorted, disjoint [start, end) runs of block numbers. hwm is the highest row known to hold data, or -1.
+    """
+    def __init__(self, runs=(), hwm=-1):
+        self.runs = [list(run) for run in runs]
+        self.hwm = hwm
+
+    def add(self, rownum):
+        # Mark a row as holding data. Returns whether the runs changed.
+        self.hwm = max(self.hwm, rownum)
+        block = rownum // BLOCK_ROWS
+        runs = self.runs
+        if runs and runs[-1][0] <= block < runs[-1][1]:
+            return False # Fast path: the newest block, which is where live data goes
+
+        i = bisect.bisect_right(runs, [block, math.inf]) # First run starting after block
+        before = runs[i-1] if i > 0 else None
+        after = runs[i] if i < len(runs) else None
+        if before and block < before[1]:
+            return False
+        elif before and before[1] == block and after and after[0] == block + 1:
+            before[1] = after[1]
+            del runs[i]
+        elif before and before[1] == block:
+            before[1] = block + 1
+        elif after and after[0] == block + 1:
+            after[0] = block
+        else:
+            runs.insert(i, [block, block + 1])
+        return True
+
+    def ranges(self, start=0, end=SENSOR_ROWS):
+        # Yield the [start, end) row ranges which may hold data, within the given rows
+        end = min(end, self.hwm + 1)
+        for block_start, block_end in self.runs:
+            run_start, run_end = max(block_start*BLOCK_ROWS, start), min(block_end*BLOCK_ROWS, end)
+            if run_start < run_end:
+                yield (run_start, run_end)
+
+    @classmethod
+    def from_records(cls, records, start=0):
+        # Build the index from a records() array which begins at row start
+        assert start % BLOCK_ROWS == 0
+        occupancy = cls()
+        for chunk in range(0, len(records), CHUNK_ROWS):
+            mask = nonempty(records[chunk:chunk+CHUNK_ROWS])
+            for i in numpy.flatnonzero(mask.reshape(-1, BLOCK_ROWS).any(axis=1)).tolist():
+                occupancy.add(start + chunk + i*BLOCK_ROWS)
+            present = numpy.flatnonzero(mask)
+            if len(present):
+                occupancy.hwm = start + chunk + int(present[-1])
+        return occupancy
 
 class Database():
-    def __init__(self, sensors, path):
+    def __init__(self, sensors, path, checkpoint_rows=None, checkpoint_interval=None, fsync=True, preallocate=False, readonly=False):
         self.path = path
-        if not os.path.exists(path):
+        self.readonly = readonly # Read-only databases never write any file. sensors is ignored.
+        self.preallocate = preallocate # Reserve disk blocks for new sensors, rather than leaving the file sparse
+        self.timings = {} # Seconds spent in each part of startup
+        started = time.perf_counter()
+
+        # Durability policy. Written rows are buffered until a checkpoint, which happens
+        # after checkpoint_rows rows or checkpoint_interval seconds (whichever is set and
+        # comes first), or when checkpoint() is called. A checkpoint fsyncs unless fsync=False.
+        self.checkpoint_rows = checkpoint_rows
+        self.checkpoint_interval = checkpoint_interval
+        self.fsync = fsync
+        self.uncommitted_rows = 0
+        self.checkpointed_at = time.monotonic()
+        self.stats = {
+            "rows": 0, # Rows written
+            "writes": 0, # Calls to write, after merging adjacent rows
+            "bytes": 0,
+            "checkpoints": 0,
+        }
+
+        self.index_path = path + ".index"
+        self._metadata = None # Parsed on first use, see metadata
+        if readonly:
+            self.f = open(path, "rb")
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.tiers = tiers.Tiers(path, self.count_sensors(), readonly=True)
+            except FileNotFoundError:
+                self.tiers = None
+            self.load_index()
+            metrics.timed(self.timings, "open", started)
+            return
+
+        created = not os.path.exists(path)
+        if created:
             self.make_database(sensors, path)
         self.f = open(path, "r+b")
         if self.count_sensors() < len(sensors):
             self.expand_database(sensors)
-        self.metadata = self.get_all_metadata()
+        self.f.flush()
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        started = metrics.timed(self.timings, "open", started)
+
+        self.tiers = tiers.Tiers(path, self.count_sensors())
+        if created:
+            self.occupancy = [Occupancy() for _ in range(self.count_sensors())]
+            self.save_index()
+        else:
+            self.load_index()
+        started = metrics.timed(self.timings, "index", started)
+        if self.tiers.created:
+            self.tiers.rebuild(self, fresh=all(tier.created for tier in self.tiers.tiers))
+        metrics.timed(self.timings, "tiers", started)
+
+    def allocate(self, old_sensors, new_sensors):
+        # Grow the file to hold new sensor sections, full of zeros. Sparse unless preallocating.
+        self.f.flush()
+        self.f.truncate(new_sensors*SENSOR_LENGTH)
+        if self.preallocate:
+            os.posix_fallocate(self.f.fileno(), old_sensors*SENSOR_LENGTH, (new_sensors - old_sensors)*SENSOR_LENGTH)
 
     def expand_database(self, sensors):
         old_sensors = self.count_sensors()
         new_sensors = len(sensors) - old_sensors
 
         # Filled it with zeros
-        self.f.seek(0, io.SEEK_END)
-        assert self.f.tell() == (old_sensors*SENSOR_LENGTH)
-        for i in range(new_sensors):
-            self.f.write(b'\0' * SENSOR_LENGTH)
+        self.allocate(old_sensors, old_sensors + new_sensors)
 
         # Write the metadata
         for i in range(len(sensors)):
@@ -65,8 +215,7 @@ class Database():
         self.f = open(path, "wb")
 
         # Filled it with zeros
-        for i in range(len(sensors)):
-            self.f.write(b'\0' * SENSOR_LENGTH)
+        self.allocate(0, len(sensors))
 
         # Write the metadata
         for i in range(len(sensors)):
@@ -80,20 +229,30 @@ class Database():
         self.f.seek(SENSOR_LENGTH*n)
         self.f.write(md)
         self.f.write(b'\0'*(METADATA_LENGTH - len(md)))
+        self._metadata = None
 
     def count_sensors(self):
-        self.f.seek(0, os.SEEK_END)
-        length = self.f.tell()
+        length = os.fstat(self.f.fileno()).st_size
         assert length % SENSOR_LENGTH == 0
         return length // SENSOR_LENGTH
 
+    @property
+    def metadata(self):
+        # Metadata for every sensor, read from the headers once and then cached
+        if self._metadata is None:
+            started = time.perf_counter()
+            self._metadata = [self.get_metadata(i) for i in range(self.count_sensors())]
+            metrics.timed(self.timings, "metadata", started)
+        return self._metadata
+
     def get_all_metadata(self):
-        return [self.get_metadata(i) for i in range(self.count_sensors())]
+        return self.metadata
 
     def get_metadata(self, n):
-        self.f.seek(SENSOR_LENGTH*n)
-        section = self.f.read(METADATA_LENGTH)
-        section = section.split(b'\n\0', 1)[0]
+        # Only read as far as the end of the JSON, not the whole header
+        start = SENSOR_LENGTH*n
+        end = self.mm.find(b'\n\0', start, start + METADATA_LENGTH)
+        section = self.mm[start:end if end >= 0 else start + METADATA_LENGTH]
 
         # Assert the format is version 1
         assert section.startswith(b'1\n')
@@ -105,50 +264,310 @@ class Database():
         assert md[0] == 1 and len(md) == 2
         return md[1]
 
-        return md
+    def load_index(self):
+        # Load the occupancy index. If it's missing, rebuild it. If it's older than the database (we crashed), rescan rows written since.
+        try:
+            with open(self.index_path, "rb") as f:
+                lines = f.read().decode('utf8').splitlines()
+            version, header = json.loads(lines[0]), json.loads(lines[1])
+            assert version == INDEX_VERSION
+            self.occupancy = [Occupancy(**json.loads(line)) for line in lines[2:]]
+            self.index_mtime_ns = os.stat(self.index_path).st_mtime_ns
+        except (OSError, ValueError, IndexError, AssertionError):
+            self.rebuild_index()
+            return
+
+        # Sections added since the index was saved start out empty
+        for _ in range(len(self.occupancy), self.count_sensors()):
+            self.occupancy.append(Occupancy())
+
+        # The writer's index is, by definition, what it has committed. Readers take it as is.
+        if not self.readonly and header["mtime_ns"] != os.fstat(self.f.fileno()).st_mtime_ns:
+            now = self.ts2rownum(datetime.datetime.now(datetime.UTC))
+            for sensor, occupancy in enumerate(self.occupancy):
+                start = occupancy.hwm + 1
+                rownums, _ = self.read_arrays(sensor, start, now + 1, indexed=False)
+                for rownum in rownums.tolist():
+                    occupancy.add(rownum)
+                    self.tiers.mark(sensor, rownum)
+            self.flush()
+            self.save_index()
+
+    def rebuild_index(self):
+        # Scan the entire file to rebuild the occupancy index
+        self.occupancy = [Occupancy.from_records(self.records(sensor)) for sensor in range(self.count_sensors())]
+        self.index_mtime_ns = None
+        if not self.readonly:
+            self.save_index()
+
+    def refresh(self):
+        # For readers: pick up whatever the writer has committed since we looked. Cheap if nothing changed.
+        try:
+            if os.stat(self.index_path).st_mtime_ns == self.index_mtime_ns:
+                return
+        except FileNotFoundError:
+            return
+        if os.fstat(self.f.fileno()).st_size > len(self.mm):
+            # The writer added sensors
+            self._metadata = None
+            try:
+                self.mm.close()
+            except BufferError:
+                pass # A records() view is still alive; the old map is released along with it
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.tiers is not None:
+                self.tiers.close()
+                self.tiers = tiers.Tiers(self.path, self.count_sensors(), readonly=True)
+        self.load_index()
+
+    def latest_rownum(self, sensor):
+        # The newest committed row for a sensor, or -1 if there's none
+        # Readers should call this (or refresh) to see new data
+        if self.readonly:
+            self.refresh()
+        return self.occupancy[sensor].hwm
+
+    def save_index(self):
+        # Atomically replace the index file. Stamped with the database's mtime, to detect later writes.
+        self.f.flush()
+        header = {"mtime_ns": os.fstat(self.f.fileno()).st_mtime_ns}
+        lines = [json.dumps(INDEX_VERSION), json.dumps(header)]
+        lines += [json.dumps({"runs": o.runs, "hwm": o.hwm}) for o in self.occupancy]
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+        os.replace(tmp_path, self.index_path)
+        self.index_mtime_ns = os.stat(self.index_path).st_mtime_ns
+
+    def pread(self, length, offset):
+        # Read without touching the shared file offset, so threads can read while another writes
+        self.f.flush()
+        return os.pread(self.f.fileno(), length, offset)
 
     def rownum2ts(self, i):
-        return EPOCH + datetime.timedelta(minutes=5*i)
+        return rownum2ts(i)
 
     def ts2rownum(self, ts):
-        ROW_SECONDS = 5 * 60
-        elapsed = ts - EPOCH
-        return math.floor(elapsed.total_seconds() / ROW_SECONDS)
-
-    def read_all_sensor(self, sensor):
+        return ts2rownum(ts)
+
+    def records(self, sensor, start=0, end=SENSOR_ROWS):
+        # A zero-copy view of rows [start, end) for one sensor, as a RECORD_DTYPE array
+        # The view stays valid until the database is closed
+        start, end = max(start, 0), min(end, SENSOR_ROWS)
+        self.f.flush()
+        return numpy.frombuffer(self.mm, dtype=RECORD_DTYPE, count=max(end - start, 0),
+            offset=SENSOR_LENGTH*sensor + METADATA_LENGTH + start*10)
+
+    def read_arrays(self, sensor, start=0, end=SENSOR_ROWS, indexed=True):
+        # The non-empty rows in [start, end) for one sensor, as (rownums, records) arrays
+        # Unlike records(), the returned records are a copy
+        # Only blocks marked in the occupancy index are read, unless indexed=False
+        if not indexed:
+            ranges = [(max(start, 0), min(end, SENSOR_ROWS))]
+        else:
+            ranges = list(self.occupancy[sensor].ranges(start, end))
+        all_rownums, all_records = [], []
+        for range_start, range_end in ranges:
+            records = self.records(sensor, range_start, range_end)
+            rownums = numpy.flatnonzero(nonempty(records))
+            all_rownums.append(rownums + range_start)
+            all_records.append(records[rownums])
+        if not all_rownums:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=RECORD_DTYPE)
+        return numpy.concatenate(all_rownums), numpy.concatenate(all_records)
+
+    def ts2rownum_range(self, start_ts=None, end_ts=None):
+        # The rows [start, end) with start_ts <= ts < end_ts. A missing bound means unbounded.
+        start, end = 0, SENSOR_ROWS
+        if start_ts is not None:
+            start = self.ts2rownum(start_ts)
+            if self.rownum2ts(start) < start_ts:
+                start += 1 # start_ts falls partway through a row
+        if end_ts is not None:
+            end = self.ts2rownum(end_ts)
+            if self.rownum2ts(end) < end_ts:
+                end += 1
+        return max(start, 0), min(end, SENSOR_ROWS)
+
+    def read_all_sensor(self, sensor, start=0, end=SENSOR_ROWS):
         # Iterate over all records for one sensor as (sensor, ts, record) tuples
         # Records go from oldest to newest
-        self.f.seek(SENSOR_LENGTH*sensor + METADATA_LENGTH)
-        preload = self.f.read(SENSOR_LENGTH - METADATA_LENGTH)
-        for rownum, x in enumerate(preload[::10]):
-            if x != 0:
-                record = preload[rownum*10:rownum*10+10]
-                yield (sensor, self.rownum2ts(rownum), record)
-
-    def read_all(self):
-        # Iterate over all records as (ts, sensor, record) tuples
-        # Records go from oldest to newest within each sensor
-        # Sensors may be grouped or interleaved.
-        # TODO: n-way merge, return interleaved
-        for sensor in range(self.count_sensors()):
-            yield from self.read_all_sensor(sensor)
+        # Only rows in [start, end) are read, skipping blocks the occupancy index says are empty
+        base = SENSOR_LENGTH*sensor + METADATA_LENGTH
+        for range_start, range_end in self.occupancy[sensor].ranges(start, end):
+            for chunk in range(range_start, range_end, CHUNK_ROWS):
+                chunk_end = min(chunk + CHUNK_ROWS, range_end)
+                for rownum in numpy.flatnonzero(nonempty(self.records(sensor, chunk, chunk_end))).tolist():
+                    rownum += chunk
+                    record = self.mm[base + rownum*10:base + rownum*10 + 10]
+                    yield (sensor, self.rownum2ts(rownum), record)
+
+    def read_range(self, sensors, start_ts, end_ts, arrays=False, skip_empty=True):
+        # Read the rows with start_ts <= ts < end_ts, with one seek and one bulk read per sensor
+        # Returns a list of (sensor, ts, record) tuples, oldest to newest within each sensor,
+        # or with arrays=True, a dict of {sensor: (rownums, records)} numpy arrays
+        # With skip_empty=False, empty rows are returned too (as all-zero records)
+        start, end = self.ts2rownum_range(start_ts, end_ts)
+        result = {} if arrays else []
+        for sensor in sensors:
+            span_start, span_end = start, end
+            if skip_empty:
+                # Nothing to read outside the occupied span
+                occupied = list(self.occupancy[sensor].ranges(start, end))
+                span_start, span_end = (occupied[0][0], occupied[-1][1]) if occupied else (start, start)
+            span_end = max(span_start, span_end)
+
+            records = numpy.frombuffer(self.pread((span_end - span_start)*10,
+                SENSOR_LENGTH*sensor + METADATA_LENGTH + span_start*10), dtype=RECORD_DTYPE)
+            rownums = numpy.arange(span_start, span_end, dtype=numpy.int64)
+            if skip_empty:
+                mask = nonempty(records)
+                rownums, records = rownums[mask], records[mask]
+
+            if arrays:
+                result[sensor] = (rownums, records)
+            else:
+                for rownum, record in zip(rownums.tolist(), records):
+                    result.append((sensor, self.rownum2ts(rownum), record.tobytes()))
+        return result
+
+    def read_all(self, start_ts=None, end_ts=None):
+        # Iterate over all records as (sensor, ts, record) tuples, oldest to newest
+        # Sensors are merged by timestamp, in the order the events arrived live. Ties go to the lower sensor.
+        # Optionally, only rows with start_ts <= ts < end_ts
+        # Each sensor is read a chunk at a time, so memory use is bounded
+        start, end = self.ts2rownum_range(start_ts, end_ts)
+        sources = [self.read_all_sensor(sensor, start, end) for sensor in range(self.count_sensors())]
+        return heapq.merge(*sources, key=lambda e: e[1])
 
     def read_ts(self, sensor, ts):
         return self.read_rownum(sensor, self.ts2rownum(ts))
         
     def read_rownum(self, sensor, rownum):
-        self.f.seek(SENSOR_LENGTH*sensor + METADATA_LENGTH + rownum*10)
-        record = self.f.read(10)
+        record = self.pread(10, SENSOR_LENGTH*sensor + METADATA_LENGTH + rownum*10)
         if record != b'\0\0\0\0\0\0\0\0\0\0':
             return (sensor, self.rownum2ts(rownum), record)
 
     def write_ts(self, sensor, ts, record10):
-        self.write_rownum(sensor, self.ts2rownum(ts), record10)
+        with WRITE_SECONDS["write_ts"].time():
+            self.write_rownum(sensor, self.ts2rownum(ts), record10)
 
     def write_rownum(self, sensor, rownum, record10):
+        assert not self.readonly
         self.f.seek(SENSOR_LENGTH*sensor + METADATA_LENGTH + rownum*10)
         assert len(record10) == 10
         self.f.write(record10)
+        self.occupancy[sensor].add(rownum)
+        self.tiers.mark(sensor, rownum)
+        self.wrote(1, 1)
+
+    def write_many(self, events):
+        # Write a batch of (sensor, ts, record10) events
+        # Rows are sorted by file offset, and runs of adjacent rows go out in a single write.
+        # If a row appears more than once, the last one wins.
+        assert not self.readonly
+        with WRITE_SECONDS["write_many"].time():
+            self._write_many(events)
+
+    def _write_many(self, events):
+        rows = {}
+        for sensor, ts, record10 in events:
+            assert len(record10) == 10
+            rows[SENSOR_LENGTH*sensor + METADATA_LENGTH + self.ts2rownum(ts)*10] = (sensor, record10)
+
+        writes = 0
+        run_start, run = None, []
+        for offset in sorted(rows) + [None]:
+            if run and offset != run_start + len(run)*10:
+                self.f.seek(run_start)
+                self.f.write(b"".join(run))
+                writes += 1
+                run = []
+            if offset is None:
+                break
+            if not run:
+                run_start = offset
+            sensor, record10 = rows[offset]
+            run.append(record10)
+            rownum = (offset - SENSOR_LENGTH*sensor - METADATA_LENGTH) // 10
+            self.occupancy[sensor].add(rownum)
+            self.tiers.mark(sensor, rownum)
+        self.wrote(len(rows), writes)
+
+    def wrote(self, rows, writes):
+        self.stats["rows"] += rows
+        self.stats["writes"] += writes
+        self.stats["bytes"] += rows*10
+        ROWS_WRITTEN.inc(rows)
+        WRITES.inc(writes)
+        self.uncommitted_rows += rows
+        self.maybe_checkpoint()
+
+    def checkpoint_due(self):
+        # Seconds until a checkpoint is due by time, or None if there's nothing to commit
+        if self.uncommitted_rows == 0 or self.checkpoint_interval is None:
+            return None
+        return max(self.checkpointed_at + self.checkpoint_interval - time.monotonic(), 0)
+
+    def maybe_checkpoint(self):
+        # Checkpoint if the durability policy says it's time
+        if self.checkpoint_rows is not None and self.uncommitted_rows >= self.checkpoint_rows:
+            self.checkpoint()
+        elif self.checkpoint_due() == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Commit everything written so far: records, rollups and the occupancy index
+        # After a checkpoint, a crash (or with fsync, a power loss) loses nothing written before it
+        with CHECKPOINT_SECONDS.time():
+            if self.fsync:
+                self.sync()
+            else:
+                self.flush()
+            self.save_index()
+        self.uncommitted_rows = 0
+        self.checkpointed_at = time.monotonic()
+        self.stats["checkpoints"] += 1
+
+    def read_tier(self, name, sensor, start_ts=None, end_ts=None):
+        # Rollups from the "hourly", "daily" or "monthly" tier for buckets starting in [start_ts, end_ts)
+        # Returns (buckets, records) arrays of the non-empty buckets, see tiers.TIER_DTYPE
+        if self.tiers is None:
+            raise FileNotFoundError("no rollup tiers for {}".format(self.path))
+        self.flush()
+        tier = self.tiers[name]
+        start, end = 0, tier.buckets
+        if start_ts is not None:
+            start = tier.ts2bucket(start_ts)
+            if tier.bucket2ts(start) < start_ts:
+                start += 1
+        if end_ts is not None:
+            end = tier.ts2bucket(end_ts)
+            if tier.bucket2ts(end) < end_ts:
+                end += 1
+        return tier.read(sensor, start, end)
+
+    def flush(self):
+        # Write out buffered records, and bring the rollup tiers up to date
+        if self.readonly:
+            return
+        self.f.flush()
+        self.tiers.update(self)
+
+    def sync(self):
+        # Push written records (and rollups) all the way to disk
+        self.flush()
+        os.fsync(self.f.fileno())
+        for tier in self.tiers.tiers:
+            tier.mm.flush()
 
     def close(self):
+        if not self.readonly:
+            self.checkpoint()
+        if self.tiers is not None:
+            self.tiers.close()
+        try:
+            self.mm.close()
+        except BufferError:
+            pass # A records() view is still alive; the map is released along with it
         self.f.close()
@@ -0,0 +1,55 @@
+"""
+How time is numbered, for the database, its rollup tiers and the summary.
+
+Rows are 5-minute slots since EPOCH (UTC), as in database.py. Hours are UTC hours since EPOCH. Days are local (US/Eastern) days, numbered from the local date of EPOCH.
+"""
+
+import datetime
+import math
+import numpy
+import pytz
+
+EPOCH = datetime.datetime(2024, 1, 1, 0, 0, 0, tzinfo=datetime.UTC)
+TZ = pytz.timezone('US/Eastern')
+START_DATE = EPOCH.astimezone(TZ).date() # Day 0
+ROW_SECONDS = 5 * 60
+ROWS_PER_HOUR = 3600 // ROW_SECONDS
+SENSOR_ROWS = 64 * 365 * 24 * ROWS_PER_HOUR # Rows per sensor: 64 years
+
+def date2day(date):
+    return (date - START_DATE).days
+
+def day2date(day):
+    return START_DATE + datetime.timedelta(days=day)
+
+def ts2day(ts):
+    # The local day number of a timestamp
+    return date2day(ts.astimezone(TZ).date())
+
+def ts2rownum(ts):
+    return math.floor((ts - EPOCH).total_seconds() / ROW_SECONDS)
+
+def rownum2ts(rownum):
+    return EPOCH + datetime.timedelta(seconds=ROW_SECONDS*rownum)
+
+def ts2hour(ts):
+    # The hour number (since EPOCH) of a timestamp
+    return math.floor((ts - EPOCH).total_seconds() / 3600)
+
+def hour2ts(hour):
+    return EPOCH + datetime.timedelta(hours=hour)
+
+# When each of TZ's UTC offsets starts, and the offset, both in seconds: the table pytz itself looks offsets up in
+TRANSITION_SECONDS = numpy.array([
+    (ts - EPOCH.replace(tzinfo=None)).total_seconds() for ts in TZ._utc_transition_times
+], dtype=numpy.int64)
+TRANSITION_OFFSETS = numpy.array([
+    utcoffset.total_seconds() for utcoffset, _, _ in TZ._transition_info
+], dtype=numpy.int64)
+
+def rownums2days(rownums):
+    # Vectorized local day number of database rows. Handles DST, by searching TZ's transitions as astimezone does.
+    seconds = numpy.asarray(rownums, dtype=numpy.int64) * ROW_SECONDS
+    transitions = numpy.maximum(numpy.searchsorted(TRANSITION_SECONDS, seconds, side="right") - 1, 0)
+    local_seconds = seconds + TRANSITION_OFFSETS[transitions] # Seconds since midnight 2024-01-01, local time
+    return local_seconds // 86400 + date2day(EPOCH.date())
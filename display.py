@@ -1,13 +1,24 @@
+"""
+The reports (the dashboard), kept up to date as readings come in.
+
+Each update first computes a Report from the State: the numbers behind every section, in °C, shared by all outputs. Then each renderer formats the Report as one file: plain text (in °C or °F), JSON, or CSV. Adding an output only costs formatting.
+
+Both levels are incremental. The Display keeps the hourly means and daily ranges between updates, and only recomputes hours and days with new readings. Each renderer caches its formatted lines the same way.
+"""
+
 from collections import defaultdict
+import csv
 import datetime
-import pytz
-import statistics
+import io
+import json
+import metrics
 import struct
 import sys
+import os
 import os.path
-
-EPOCH = datetime.datetime(2024, 1, 1, 0, 0, 0, tzinfo=datetime.UTC)
-TZ    = pytz.timezone('US/Eastern')
+import time
+from dates import TZ, day2date, ts2day, ts2hour, hour2ts, ts2rownum, ROW_SECONDS
+from state import CADENCE_ROWS, HOURLY_KEEP
 
 # All rooms
 # These are row indices into SENSORS, not sensor numbers
@@ -23,31 +34,123 @@ GROUPS = {
     "inside": INSIDE,
 }
 
+UNITS = ["c", "f"]
+HOURLY_WINDOW = datetime.timedelta(days=2) # Hours considered for the hourly table
+assert HOURLY_WINDOW < HOURLY_KEEP, "State only keeps HOURLY_KEEP of hourly rollups"
+HIGH_LOW_CHUNK = 50 # Days between repeated column headers
+HEALTH_DAYS = 7 # Days considered for sensor health
+
+SECTIONS = ["current", "hourly", "high_low", "health"]
+MODEL_SECONDS = {section: metrics.histogram("display_model_seconds", "Time to compute each section of the report model", section=section) for section in SECTIONS}
+WRITE_SECONDS = metrics.histogram("display_write_seconds", "Time to write a report file")
+UPDATE_SECONDS = metrics.histogram("display_update_seconds", "Time to update all the reports")
+
 ABOUT = """
 Code: https://github.com/za3k/temp-monitor
 """.strip()
 
 class Display():
-    def __init__(self, sensors, report_dir, report_name):
+    def __init__(self, sensors, report_dir, report_name, min_interval=5, max_latency=30, log_events=True, renderers=None):
         self.report_dir = report_dir
         self.report_name = report_name
+        # Each renderer writes one file in report_dir. By default, the text reports, in each unit.
+        if renderers is None:
+            renderers = [TextRenderer(report_name.format(unit=unit), unit) for unit in UNITS]
+        self.renderers = renderers
+        self.log_events = log_events # Print every reading to stderr. This is a real cost at high message rates.
+
+        # Scheduled updates (see schedule) are coalesced: an update happens once no new
+        # change has arrived for min_interval seconds, but at most max_latency seconds
+        # after the first change that's still not shown
+        self.min_interval = min_interval
+        self.max_latency = max_latency
+        self.pending_since = None # time.monotonic() of the oldest change not yet shown
+        self.last_change = None
+        self.written = {} # path -> contents, as last written or read from disk
+
+        # Historical statistics are cached between updates, and only recomputed when a reading touches them
+        self.seen_updates = None # state.last_update as of the previous update
+        self.hour_means = {} # hour -> mean of each group
+        self.day_ranges = {} # day -> (low, high) of each group
+
+    def schedule(self, state):
+        # Note that the state changed. The reports will be updated by flush_due.
+        now = time.monotonic()
+        if self.pending_since is None:
+            self.pending_since = now
+        self.last_change = now
+        self.flush_due(state)
+
+    def wait_time(self):
+        # Seconds until a scheduled update is due, or None if nothing is pending
+        if self.pending_since is None:
+            return None
+        due = min(self.last_change + self.min_interval, self.pending_since + self.max_latency)
+        return max(due - time.monotonic(), 0)
+
+    def flush_due(self, state):
+        # Update the reports if a scheduled update is due
+        if self.wait_time() == 0:
+            self.update(state)
+
+    def flush(self, state):
+        # Update the reports now if any update is scheduled
+        if self.pending_since is not None:
+            self.update(state)
 
     def update(self, state):
-        for unit in ["c", "f"]:
-            current_temps = self.current_temps(state, unit)
-            high_low = self.high_low(state, unit)
-            hourly = self.hourly(state, unit)
-
-            path = os.path.join(self.report_dir, self.report_name.format(unit=unit))
-            with open(path, "w") as f:
-                f.write("\n-------------\n\n".join([
-                    current_temps,
-                    hourly,
-                    high_low,
-                    ABOUT
-                ]))
+        with UPDATE_SECONDS.time():
+            self._update(state)
+
+    def _update(self, state):
+        self.pending_since = self.last_change = None
+        report = self.report(state)
+        for renderer in self.renderers:
+            with renderer.seconds.time():
+                text = renderer.render(report)
+            with WRITE_SECONDS.time():
+                self.write_report(os.path.join(self.report_dir, renderer.filename), text)
+
+    def write_report(self, path, text):
+        # Atomically replace a report, so readers never see a partial file. Skipped if nothing changed.
+        contents = text.encode("utf8")
+        if path not in self.written:
+            try:
+                with open(path, "rb") as f:
+                    self.written[path] = f.read()
+            except OSError:
+                pass
+        if self.written.get(path) == contents:
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.written[path] = contents
+
+    def invalidate(self, state):
+        # Find which days and hours have new readings since the last update. None means all of them.
+        updates = list(state.last_update)
+        seen_updates, self.seen_updates = self.seen_updates, updates
+        if seen_updates is None or len(seen_updates) != len(updates):
+            self.hour_means.clear()
+            self.day_ranges.clear()
+            return None, None
+
+        dirty_days, dirty_hours = set(), set()
+        oldest_hour = ts2hour(datetime.datetime.now(datetime.UTC) - HOURLY_WINDOW)
+        for before, after in zip(seen_updates, updates):
+            if before != after:
+                before, after = min(before, after), max(before, after)
+                dirty_days.update(range(ts2day(before), ts2day(after)+1))
+                dirty_hours.update(range(max(ts2hour(before), oldest_hour), ts2hour(after)+1))
+        return dirty_days, dirty_hours
 
     def log(self, event):
+        if not self.log_events:
+            return
         sensor, ts, record = event
         ts = self.readable_time(ts)
         print("{}, Sensor #{}\n  {}\n  {}".format(ts, sensor+1, self.record2human(record), list(record)), file=sys.stderr)
@@ -91,6 +194,18 @@ class Display():
         else:
             return "{} minutes ago".format(minutes)
 
+    @staticmethod
+    def readable_duration(td):
+        days = td.days
+        hours = td.seconds // 3600
+        minutes = (td.seconds - hours*3600) // 60
+        if days > 0:
+            return "{} days, {} hours".format(days, hours)
+        elif hours > 0:
+            return "{} hours, {:0>2} min".format(hours, minutes)
+        else:
+            return "{} minutes".format(minutes)
+
     @staticmethod
     def c2f(x):
         return x*9/5+32
@@ -126,103 +241,314 @@ class Display():
             assert unit == "c"
             return "{: >6.2f} - {: >6.2f}°C".format(lo, hi)
 
-    def current_temps(self, state, unit):
-        now = datetime.datetime.now(datetime.UTC)
+    def report(self, state):
+        # Compute the Report, reusing whatever no new reading has touched
+        report = Report()
+        report.now = now = datetime.datetime.now(datetime.UTC)
+        report.dirty_days, report.dirty_hours = self.invalidate(state)
+
+        with MODEL_SECONDS["current"].time():
+            for sensor in DISPLAY_ORDER:
+                name = state.db_metadata[sensor]["human_readable"][5:]
+                report.current.append((name, state.temps[sensor] or None, state.humid[sensor] or None, state.last_update[sensor]))
+
+        with MODEL_SECONDS["hourly"].time():
+            # Hours with any readings in the window. The newest (current) hour is incomplete, and not shown.
+            oldest_hour = ts2hour(now - HOURLY_WINDOW) + 1
+            buckets = set()
+            for sensors in GROUPS.values():
+                for sensor in sensors:
+                    hours = state.hourly[sensor].buckets()
+                    buckets.update(hours[hours >= oldest_hour].tolist())
+            report.hours = sorted(buckets)[-13:-1]
+            for hour in list(self.hour_means):
+                if hour < oldest_hour:
+                    del self.hour_means[hour]
+            for hour in report.hours:
+                if hour not in self.hour_means or report.dirty_hours is None or hour in report.dirty_hours:
+                    self.hour_means[hour] = self.hour_mean(state, hour)
+            report.hour_means = self.hour_means
+
+        with MODEL_SECONDS["high_low"].time():
+            for sensors in GROUPS.values():
+                for sensor in sensors:
+                    days = state.daily[sensor].buckets()
+                    if len(days):
+                        report.min_day = min(report.min_day, int(days[0])) if report.min_day is not None else int(days[0])
+                        report.max_day = max(report.max_day, int(days[-1])) if report.max_day is not None else int(days[-1])
+            if report.min_day is not None:
+                for day in range(report.min_day, report.max_day+1):
+                    if day not in self.day_ranges or report.dirty_days is None or day in report.dirty_days:
+                        self.day_ranges[day] = self.day_range(state, day)
+            report.day_ranges = self.day_ranges
+
+        with MODEL_SECONDS["health"].time():
+            report.health = self.health(state, now)
+        return report
+
+    def hour_mean(self, state, hour):
+        # The mean of each group, for one hour
+        means = []
+        for sensors in GROUPS.values():
+            total, count = 0, 0
+            for sensor in sensors:
+                hour_stats = state.hourly[sensor].get(hour)
+                if hour_stats:
+                    total += hour_stats[2] * hour_stats[3]
+                    count += hour_stats[3]
+            means.append(total / count if count else None)
+        return tuple(means)
 
+    def day_range(self, state, day):
+        # The (low, high) of each group, for one day
+        ranges = []
+        for sensors in GROUPS.values():
+            low, high = None, None
+            for sensor in sensors:
+                day_stats = state.daily[sensor].get(day)
+                if day_stats:
+                    low = day_stats[0] if low is None else min(low, day_stats[0])
+                    high = day_stats[1] if high is None else max(high, day_stats[1])
+            ranges.append((low, high))
+        return tuple(ranges)
+
+    def health(self, state, now):
+        # Battery, link quality and dropped readings over the last HEALTH_DAYS days, to spot dying sensors
+        today = ts2day(now)
+        now_row = ts2rownum(now)
+        start_row = ts2rownum(now - datetime.timedelta(days=HEALTH_DAYS))
+        health = []
+        for sensor in DISPLAY_ORDER:
+            h = state.health[sensor]
+            days = [day for day in h.days(today - HEALTH_DAYS, today) if day is not None] # Whole days only
+            gaps = h.gaps(start_row, now_row, as_of=now_row)
+            silence = h.silence(now_row)
+            health.append(SensorHealth(
+                name=state.db_metadata[sensor]["human_readable"][5:],
+                battery=days[-1][1] if days else None,
+                link=sum(day[4] * day[0] for day in days) / sum(day[0] for day in days) if days else None,
+                reports=sum(day[0] for day in days) / HEALTH_DAYS, # Days without readings count as 0
+                gaps=len(gaps),
+                longest=max(min(end, now_row) - max(start, start_row) for start, end in gaps)*ROW_SECONDS if gaps else None,
+                silence=silence*ROW_SECONDS if silence is not None else None,
+            ))
+        return health
+
+class Report():
+    """
+    The numbers behind the reports, as of one update. Temperatures are in °C, and None means no readings.
+
+    hour_means and day_ranges are shared with the Display, and kept between updates. dirty_hours and dirty_days say which of them changed since the previous Report (None means all), so renderers can cache what they draw.
+    """
+    def __init__(self):
+        self.now = None
+        self.current = [] # (name, temperature, humidity, last update) per sensor, in DISPLAY_ORDER
+        self.hours = [] # The hours in the hourly table, oldest first
+        self.hour_means = {} # hour -> mean of each group, in GROUPS order
+        self.min_day = None # Days with readings, for the highs and lows
+        self.max_day = None
+        self.day_ranges = {} # day -> (low, high) of each group, in GROUPS order
+        self.health = [] # SensorHealth per sensor, in DISPLAY_ORDER
+        self.dirty_hours = None
+        self.dirty_days = None
+
+class SensorHealth():
+    """How one sensor has been reporting over the last HEALTH_DAYS days. None means unknown."""
+    def __init__(self, name, battery, link, reports, gaps, longest, silence):
+        self.name = name
+        self.battery = battery # Battery level (%) on the newest whole day
+        self.link = link # Mean link quality
+        self.reports = reports # Mean readings per day, over all HEALTH_DAYS
+        self.gaps = gaps # Number of gaps
+        self.longest = longest # Seconds missing in the longest gap
+        self.silence = silence # Seconds since the newest reading
+
+class Renderer():
+    """Formats a Report as the contents of one file"""
+    name = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.seconds = metrics.histogram("display_render_seconds", "Time to format each report file", file=filename)
+
+    def render(self, report):
+        raise NotImplementedError
+
+class TextRenderer(Renderer):
+    """The plain text report, in °C or °F"""
+    def __init__(self, filename, unit):
+        super().__init__(filename)
+        assert unit in UNITS
+        self.unit = unit
+        # Historical lines are cached between updates, and only redrawn when a reading touches them
+        self.hour_lines = {} # hour -> line of the hourly table
+        self.day_lines = {} # day -> line of the highs and lows
+        self.day_chunks = {} # chunk number -> HIGH_LOW_CHUNK lines with a header
+        self.day_chunks_span = None # (newest, oldest) day when day_chunks were drawn
+
+    def render(self, report):
+        if report.dirty_days is None:
+            self.day_lines.clear()
+        if report.dirty_hours is None:
+            self.hour_lines.clear()
+        return "\n-------------\n\n".join([
+            self.current_temps(report),
+            self.hourly(report),
+            self.high_low(report),
+            self.health(report),
+            ABOUT
+        ])
+
+    def current_temps(self, report):
+        unit = self.unit
         current_temps = "Current Temperature\n"
-        current_temps += "  last updated: {}\n".format(self.readable_time(now))
+        current_temps += "  last updated: {}\n".format(Display.readable_time(report.now))
         current_temps += "\n"
         current_temps += "Sensor                        Temperature  Humidity    Last update\n"
-        for sensor in DISPLAY_ORDER:
-            temperature = self.readable_temp(state.temps[sensor] or None, unit)
-            humidity = self.readable_humidity(state.humid[sensor] or None)
-            last_update = state.last_update[sensor]
-            elapsed = self.readable_timedelta(now - last_update)
-            human_readable = state.db_metadata[sensor]["human_readable"][5:]
+        for human_readable, temp, humid, last_update in report.current:
+            temperature = Display.readable_temp(temp, unit)
+            humidity = Display.readable_humidity(humid)
+            elapsed = Display.readable_timedelta(report.now - last_update)
             current_temps += "{: <27s}   {}     {}     {: <10s}\n".format(human_readable, temperature, humidity, elapsed)
         return current_temps
 
-    def hourly(self, state, unit):
-        now = datetime.datetime.now(datetime.UTC)
-        today = now.astimezone(TZ).date()
-        yesterday = today - datetime.timedelta(days=1)
-        
+    def hourly(self, report):
         hourly = "Hourly Temperature\n"
-        hourly += "  last updated: {}\n".format(self.readable_time(now))
+        hourly += "  last updated: {}\n".format(Display.readable_time(report.now))
         hourly += "\n"
 
-        def hour_bucket(ts):
-            return ts.replace(second=0, microsecond=0, minute=0)
-        def format_temp(xs):
-            if xs is None or len(xs) == 0:
-                return self.readable_temp(None, unit)
-            else:
-                return self.readable_temp(statistics.mean(xs), unit)
-
-        report_hours = {groupname: {} for groupname in GROUPS.keys()}
-        buckets = set()
-        for groupname, sensors in GROUPS.items():
-            for sensor in sensors:
-                for ts, temp in state.timeseries[sensor]:
-                    hour = hour_bucket(ts)
-                    buckets.add(hour)
-                    if hour not in report_hours[groupname]:
-                        report_hours[groupname][hour] = []
-
-                    report_hours[groupname][hour].append(temp)
+        lines = self.hour_lines
+        for hour in list(lines):
+            if hour not in report.hour_means:
+                del lines[hour]
+        for hour in report.hours:
+            if hour not in lines or report.dirty_hours is None or hour in report.dirty_hours:
+                lines[hour] = self.hourly_line(hour, report.hour_means[hour])
 
-        hourly += "{}   ".format(self.readable_hour(" "))
+        hourly += "{}   ".format(Display.readable_hour(" "))
         for groupname in GROUPS.keys():
             hourly += "{: <11s}".format(groupname)
         hourly += "\n"
-        for hour in sorted(buckets)[-13:-1]:
-            hourly += "{}   ".format(self.readable_hour(hour))
-            for groupname in GROUPS.keys():
-                hourly += "{}   ".format(format_temp(
-                    report_hours[groupname].get(hour)))
-            hourly += "\n"
-
+        hourly += "".join(lines[hour] for hour in report.hours)
         return hourly
 
-    def high_low(self, state, unit):
-        now = datetime.datetime.now(datetime.UTC)
+    def hourly_line(self, hour, means):
+        line = "{}   ".format(Display.readable_hour(hour2ts(hour)))
+        for mean in means:
+            line += "{}   ".format(Display.readable_temp(mean, self.unit))
+        return line + "\n"
 
+    def high_low(self, report):
         high_low = "Historical highs and lows\n"
-        high_low += "  last updated: {}\n".format(self.readable_time(now))
-
-        start_date = EPOCH.astimezone(TZ).date()
-        day_count = 365*64
-
-        min_date, max_date = None, None
-        report_highs = { groupname: {} for groupname in GROUPS.keys() }
-        report_lows = { groupname: {} for groupname in GROUPS.keys() }
-        for date in (start_date + datetime.timedelta(n) for n in range(day_count)):
-            for groupname, sensors in GROUPS.items():
-                highs = report_highs[groupname]
-                lows = report_lows[groupname]
-                for sensor in sensors:
-                    high = state.highs[sensor].get(date)
-                    low = state.lows[sensor].get(date)
-                    if high and low:
-                        if date not in highs or high > highs[date]:
-                            highs[date] = high
-                        if date not in lows or low < lows[date]:
-                            lows[date] = low
-                        if min_date is None or date < min_date:
-                            min_date = date
-                        if max_date is None or date > max_date:
-                            max_date = date
-        
-        actual_day_count = (max_date-min_date).days+1
-        for line, date in enumerate(min_date + datetime.timedelta(n) for n in reversed(range(actual_day_count))):
-            if line % 50 == 0:
-                high_low += "\n{}   ".format(self.readable_date(" "))
+        high_low += "  last updated: {}\n".format(Display.readable_time(report.now))
+        min_day, max_day = report.min_day, report.max_day
+        if min_day is None:
+            return high_low
+
+        # Days are listed newest first, so when a new day starts, every chunk shifts
+        lines, chunks = self.day_lines, self.day_chunks
+        if self.day_chunks_span != (max_day, min_day) or report.dirty_days is None:
+            chunks.clear()
+            self.day_chunks_span = (max_day, min_day)
+        for day in range(min_day, max_day+1):
+            if day not in lines or report.dirty_days is None or day in report.dirty_days:
+                lines[day] = self.high_low_line(day, report.day_ranges[day])
+                chunks.pop((max_day - day) // HIGH_LOW_CHUNK, None)
+
+        for chunk in range((max_day - min_day) // HIGH_LOW_CHUNK + 1):
+            if chunk not in chunks:
+                text = "\n{}   ".format(Display.readable_date(" "))
                 for g in GROUPS.keys():
-                    high_low += "{: <20s}".format(g)
-                high_low += "\n"
-            high_low += "{}   ".format(self.readable_date(date))
-            for groupname in GROUPS.keys():
-                high_low += self.readable_temp_range(report_lows[groupname].get(date), report_highs[groupname].get(date), unit) + "   "
-            high_low += "\n"
-            
+                    text += "{: <20s}".format(g)
+                text += "\n"
+                newest = max_day - chunk*HIGH_LOW_CHUNK
+                for day in range(newest, max(newest - HIGH_LOW_CHUNK, min_day - 1), -1):
+                    text += lines[day]
+                chunks[chunk] = text
+            high_low += chunks[chunk]
         return high_low
+
+    def high_low_line(self, day, ranges):
+        line = "{}   ".format(Display.readable_date(day2date(day)))
+        for low, high in ranges:
+            line += Display.readable_temp_range(low, high, self.unit) + "   "
+        return line + "\n"
+
+    def health(self, report):
+        health = "Sensor health (last {} days)\n".format(HEALTH_DAYS)
+        health += "  last updated: {}\n".format(Display.readable_time(report.now))
+        health += "\n"
+        health += "Sensor                        Battery  Link  Reports/day  Gaps  Longest gap        Silent for\n"
+        for h in report.health:
+            battery = "{: >6.0f}%".format(h.battery) if h.battery is not None else "-------"
+            link = "{: >5.0f}".format(h.link) if h.link is not None else "-----"
+            reports = "{: >11.0f}".format(h.reports)
+            longest = Display.readable_duration(datetime.timedelta(seconds=h.longest)) if h.longest is not None else "none"
+            if h.silence is None:
+                silent = "never reported"
+            elif h.silence > CADENCE_ROWS*ROW_SECONDS:
+                silent = Display.readable_duration(datetime.timedelta(seconds=h.silence))
+            else:
+                silent = ""
+            health += "{: <27s}   {}  {}  {}  {: >4}  {: <17s}  {}\n".format(h.name, battery, link, reports, h.gaps, longest, silent)
+        return health
+
+class JSONRenderer(Renderer):
+    """Everything in the Report, as JSON. Temperatures are in °C, times in ISO 8601."""
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.days = {} # day -> JSON of its highs and lows
+
+    def render(self, report):
+        if report.dirty_days is None:
+            self.days.clear()
+        groups = list(GROUPS.keys())
+        days = []
+        if report.min_day is not None:
+            for day in range(report.max_day, report.min_day - 1, -1):
+                if day not in self.days or report.dirty_days is None or day in report.dirty_days:
+                    self.days[day] = json.dumps(dict(
+                        [("date", day2date(day).isoformat())] +
+                        [(group, {"low": low, "high": high}) for group, (low, high) in zip(groups, report.day_ranges[day])]
+                    ))
+                days.append(self.days[day])
+        rest = json.dumps({
+            "updated": report.now.isoformat(),
+            "current": [
+                {"sensor": name, "temperature": temp, "humidity": humid, "last_update": last_update.isoformat()}
+                for name, temp, humid, last_update in report.current
+            ],
+            "hourly": [
+                dict([("hour", hour2ts(hour).isoformat())] + [(group, mean if mean is None else round(mean, 2)) for group, mean in zip(groups, report.hour_means[hour])])
+                for hour in report.hours
+            ],
+            "health": [vars(h) for h in report.health],
+        })
+        # The daily list is long, so it's spliced in from the cached days rather than re-serialized
+        return rest[:-1] + ', "daily": [' + ", ".join(days) + "]}\n"
+
+class CSVRenderer(Renderer):
+    """The daily highs and lows as CSV, newest first. Temperatures are in °C."""
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.lines = {} # day -> CSV row
+
+    def render(self, report):
+        if report.dirty_days is None:
+            self.lines.clear()
+        header = ["date"] + ["{}_{}".format(group, end) for group in GROUPS.keys() for end in ("low", "high")]
+        lines = [self.row(header)]
+        if report.min_day is not None:
+            for day in range(report.max_day, report.min_day - 1, -1):
+                if day not in self.lines or report.dirty_days is None or day in report.dirty_days:
+                    self.lines[day] = self.row([day2date(day).isoformat()] + [
+                        "" if x is None else "{:.2f}".format(x) for low_high in report.day_ranges[day] for x in low_high
+                    ])
+                lines.append(self.lines[day])
+        return "".join(lines)
+
+    @staticmethod
+    def row(fields):
+        f = io.StringIO()
+        csv.writer(f).writerow(fields)
+        return f.getvalue()
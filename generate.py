@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic temperature database, for testing and benchmarks.
+
+    ./generate.py PATH [--sensors N] [--years Y] [--dropout P] [--interval MINUTES] [--end DATE] [--seed S]
+
+Writes PATH (plus its index and rollup tiers) in exactly the format of database.py, with Y years of readings ending at DATE (default: now). Each sensor reports every MINUTES minutes, and each reading is dropped with probability P, like a sensor out of radio range.
+
+Readings follow the seasons and the time of day: outside sensors (see display.OUTSIDE) swing much more than inside ones. Voltage and battery run down, and the battery is replaced every two years.
+
+The first sensors are the real ones from main.SENSORS. Any beyond those are made up.
+"""
+
+import argparse
+import datetime
+import math
+import numpy
+import os.path
+import sys
+
+import database
+import display
+import main
+
+YEAR_SECONDS = 365.2425 * 86400
+BATTERY_SECONDS = 2 * YEAR_SECONDS # How long a battery lasts
+CHUNK_ROWS = 1 << 18 # Rows generated at a time, per sensor
+
+def make_sensors(count):
+    sensors = list(main.SENSORS[:count])
+    for i in range(len(sensors), count):
+        sensors.append({
+            "mqtt_topic": "zigbee2mqtt/Temperature/Synthetic{:03}".format(i),
+            "row_id": i % 256,
+            "human_readable": "{:03} - Synthetic - Sensor {}".format(i, i),
+        })
+    return sensors
+
+def make_records(rownums, row_id, outside, rnd):
+    # Readings for the given rows, as a RECORD_DTYPE array
+    seconds = rownums * database.ROW_SECONDS
+    local_seconds = seconds - 5*3600 # Close enough to US/Eastern
+    season = -numpy.cos(2*math.pi * (seconds - 20*86400) / YEAR_SECONDS) # Coldest around January 20
+    day = -numpy.cos(2*math.pi * (local_seconds % 86400 - 3*3600) / 86400) # Coldest around 3am
+    if outside:
+        temp = 11 + 14*season + 5*day + rnd.normal(0, 1.5, len(rownums))
+        humid = 65 - 10*day + rnd.normal(0, 5, len(rownums))
+    else:
+        temp = 20 + 2*season + 0.5*day + rnd.normal(0, 0.3, len(rownums))
+        humid = 40 + 10*season + rnd.normal(0, 2, len(rownums))
+    age = (seconds % BATTERY_SECONDS) / BATTERY_SECONDS
+
+    records = numpy.zeros(len(rownums), dtype=database.RECORD_DTYPE)
+    records["version"] = 1
+    records["row_id"] = row_id
+    records["humid"] = numpy.round(numpy.clip(humid, 0, 100) * 100)
+    records["temp"] = numpy.round(temp * 100)
+    records["volt"] = numpy.round(3100 - 400*age)
+    records["linkquality"] = rnd.integers(30, 200, len(rownums))
+    records["batt"] = numpy.round(100 - 100*age)
+    return records
+
+def generate(path, sensors=len(main.SENSORS), years=1, dropout=0.05, interval=5, end=None, seed=0):
+    assert not os.path.exists(path), "{} already exists".format(path)
+    assert interval % 5 == 0 and interval > 0, "the interval must be a multiple of 5 minutes"
+    if end is None: end = datetime.datetime.now(datetime.UTC)
+    rnd = numpy.random.default_rng(seed)
+    step = interval // 5
+    sensors = make_sensors(sensors)
+
+    db = database.Database(sensors, path)
+    end_row = min(db.ts2rownum(end) + 1, database.SENSOR_ROWS)
+    start_row = max(end_row - int(years * YEAR_SECONDS) // database.ROW_SECONDS, 0)
+    for i, sensor in enumerate(sensors):
+        first = start_row + int(rnd.integers(0, step)) # Sensors don't all report at the same moment
+        for chunk_start in range(first, end_row, CHUNK_ROWS*step):
+            rownums = numpy.arange(chunk_start, min(chunk_start + CHUNK_ROWS*step, end_row), step, dtype=numpy.int64)
+            rownums = rownums[rnd.random(len(rownums)) >= dropout]
+            if len(rownums) == 0:
+                continue
+            records = db.records(i, int(rownums[0]), int(rownums[-1]) + 1)
+            records[rownums - rownums[0]] = make_records(rownums, sensor["row_id"], i in display.OUTSIDE, rnd)
+
+    # Everything was written straight into the map, so bring the index and tiers up to date in one go
+    db.mm.flush()
+    db.rebuild_index()
+    db.tiers.rebuild(db)
+    db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic temperature database")
+    parser.add_argument("path")
+    parser.add_argument("--sensors", type=int, default=len(main.SENSORS), help="number of sensors (default: %(default)s)")
+    parser.add_argument("--years", type=float, default=1, help="years of readings (default: %(default)s, at most 64)")
+    parser.add_argument("--dropout", type=float, default=0.05, help="fraction of readings lost (default: %(default)s)")
+    parser.add_argument("--interval", type=int, default=5, help="minutes between readings (default: %(default)s)")
+    parser.add_argument("--end", type=datetime.datetime.fromisoformat, help="last reading, ISO 8601 UTC (default: now)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    end = args.end.replace(tzinfo=datetime.UTC) if args.end and args.end.tzinfo is None else args.end
+    generate(args.path, args.sensors, args.years, args.dropout, args.interval, end, args.seed)
+    print("Wrote {}".format(args.path), file=sys.stderr)
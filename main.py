@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
+import aiopipeline
+import argparse
 import display
 import database
 import monitor
+import os
+import os.path
+import pipeline
 import state
 import sys
 
@@ -25,24 +30,41 @@ SENSORS=[
     {"mqtt_topic": "zigbee2mqtt/Temperature/Sensor13", "row_id": 13, "human_readable": "13 - Basement - Workshop"},         # Display: 12
 ]
 
+def make_renderers():
+    # The report files, see display.py
+    return [
+        display.TextRenderer("house-temp.c.txt", "c"),
+        display.TextRenderer("house-temp.f.txt", "f"),
+        display.JSONRenderer("house-temp.json"),
+        display.CSVRenderer("house-temp.csv"),
+    ]
+
 if __name__ == "__main__":
-    db = database.Database(sensors=SENSORS, path="temps.db")
+    parser = argparse.ArgumentParser(description="Log the temperature sensors, and keep the reports up to date")
+    parser.add_argument("--quiet", action="store_true", help="don't print every reading to stderr")
+    parser.add_argument("--asyncio", action="store_true", help="run the pipeline on asyncio, with bounded queues, rather than threads")
+    args = parser.parse_args()
+
+    db = database.Database(sensors=SENSORS, path="temps.db", checkpoint_interval=60)
     #self.write_metadata(9, sensors[9])
-    state = state.State(db, path="temps.db.cache")
+    state = state.State(db, path="temps.db.cache", workers=os.cpu_count()) # Without a cache, rebuild on every core
     sensors = state.sensors()
-    display = display.Display(sensors, report_dir="/var/www/public/pub/status", report_name="house-temp.{unit}.txt")
+    display = display.Display(sensors, report_dir="/var/www/public/pub/status", report_name="house-temp.{unit}.txt", log_events=not args.quiet, renderers=make_renderers())
     monitor = monitor.Monitor(sensors)
 
     try:
-        monitor.start_background()
+        if not args.asyncio:
+            monitor.start_background()
         display.update(state)
-        print("Loaded.", file=sys.stderr)
-        for event in monitor.events():
-            #print(event)
-            display.log(event)
-            db.write_ts(*event)
-            state.update(*event)
-            display.update(state)
+        print("Loaded. Startup took: {}".format(", ".join(
+            "{} {:.3f}s".format(name, seconds)
+            for name, seconds in list(db.timings.items()) + list(state.timings.items())
+        )), file=sys.stderr)
+        metrics_path = os.path.join(display.report_dir, "house-temp.prom")
+        if args.asyncio:
+            aiopipeline.AsyncPipeline(monitor, db, state, display, stats_interval=3600, metrics_path=metrics_path).run()
+        else:
+            pipeline.Pipeline(monitor, db, state, display, stats_interval=3600, metrics_path=metrics_path).run()
     finally:
         monitor.close()
         state.close()
@@ -0,0 +1,173 @@
+"""
+Lightweight metrics for the hot paths: counters, gauges and histograms, kept in memory and exported as a text file in the Prometheus exposition format.
+
+Metrics are made once, at import time, and are cheap to update from any thread:
+
+    DECODE_SECONDS = metrics.histogram("monitor_decode_seconds", "Time to decode one MQTT message")
+    with DECODE_SECONDS.time():
+        ...
+
+Metrics with the same name and different labels are exported together, e.g. one histogram per section of the display.
+
+One-off steps, like those of startup, are timed with timed() into a plain dict, which the caller prints.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = [
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+]
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+
+    def format_labels(self, extra={}):
+        labels = dict(self.labels, **extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + "}"
+
+class Counter(Metric):
+    """A count which only goes up"""
+    kind = "counter"
+
+    def __init__(self, name, help, labels):
+        super().__init__(name, help, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def lines(self):
+        return ["{}{} {}".format(self.name, self.format_labels(), self.value)]
+
+class Gauge(Metric):
+    """A value which is set from time to time, like a queue depth"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels):
+        super().__init__(name, help, labels)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def lines(self):
+        return ["{}{} {}".format(self.name, self.format_labels(), self.value)]
+
+class Timer():
+    """Context manager which adds the time spent inside it to a histogram"""
+    __slots__ = ["histogram", "started"]
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+class Histogram(Metric):
+    """The distribution of some value (usually seconds), in fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Per bucket, not cumulative. The last is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def lines(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + ["+Inf"], counts):
+            cumulative += n
+            lines.append("{}_bucket{} {}".format(self.name, self.format_labels({"le": bound}), cumulative))
+        lines.append("{}_sum{} {}".format(self.name, self.format_labels(), total))
+        lines.append("{}_count{} {}".format(self.name, self.format_labels(), count))
+        return lines
+
+class Registry():
+    def __init__(self):
+        self.metrics = {} # (name, labels) -> Metric, in the order made
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, labels, **kwargs):
+        # The metric with this name and labels, made if needed
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.metrics:
+                self.metrics[key] = cls(name, help, labels, **kwargs)
+            metric = self.metrics[key]
+        assert isinstance(metric, cls), "{} is a {}".format(name, metric.kind)
+        return metric
+
+    def export(self):
+        # All metrics, in the Prometheus text format
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines, described = [], set()
+        for name in dict.fromkeys(metric.name for metric in metrics):
+            for metric in metrics:
+                if metric.name != name:
+                    continue
+                if name not in described:
+                    lines.append("# HELP {} {}".format(name, metric.help))
+                    lines.append("# TYPE {} {}".format(name, metric.kind))
+                    described.add(name)
+                lines.extend(metric.lines())
+        return "".join(line + "\n" for line in lines)
+
+    def write(self, path):
+        # Atomically replace path with the current metrics, so a scraper never sees a partial file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.export())
+        os.replace(tmp_path, path)
+
+REGISTRY = Registry()
+
+def counter(name, help, **labels):
+    return REGISTRY.get(Counter, name, help, labels)
+
+def gauge(name, help, **labels):
+    return REGISTRY.get(Gauge, name, help, labels)
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    return REGISTRY.get(Histogram, name, help, labels, buckets=buckets)
+
+def write(path):
+    REGISTRY.write(path)
+
+def timed(timings, name, started):
+    # Add the seconds since started (a time.perf_counter()) to timings[name]
+    # Returns the time, to start the next step
+    now = time.perf_counter()
+    timings[name] = timings.get(name, 0) + now - started
+    return now
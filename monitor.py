@@ -1,22 +1,38 @@
 import datetime
 import json
+import metrics
 import paho.mqtt.client
 import queue
 import struct
 import sys
+import threading
+
+try:
+    import orjson # Optional, faster JSON decoding
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+RECORD = struct.Struct("!BBhhHBB")
+
+MESSAGES = metrics.counter("monitor_messages_total", "MQTT messages received")
+UNKNOWN_TOPICS = metrics.counter("monitor_unknown_topics_total", "MQTT messages from topics which aren't a known sensor")
+DECODE_SECONDS = metrics.histogram("monitor_decode_seconds", "Time to decode one MQTT message into a record")
 
 class Monitor():
-    def __init__(self, sensors, topic="zigbee2mqtt/Temperature/#"):
+    def __init__(self, sensors, topic="zigbee2mqtt/Temperature/#", record_path=None):
         self.hostname = "192.168.1.17"
         self.port = 1883
         self.sensors = sensors
         self.topic2sensor = {
-            d["mqtt_topic"]: i for i,d in enumerate(sensors)
+            d["mqtt_topic"]: (i, d["row_id"]) for i,d in enumerate(sensors)
         }
         #print(self.topic2sensor)
         self.topics = [topic]
         self.q = queue.Queue()
-        pass
+        self.deliver = self.q.put # Called with each decoded event
+        # Optionally, append every raw message to a file, to replay later (see bench.py)
+        self.record_file = open(record_path, "a") if record_path else None
 
     def start_background(self):
         self.client = paho.mqtt.client.Client()
@@ -25,56 +41,82 @@ class Monitor():
         self.client.on_connect = self.on_connect
         self.client.connect_async(self.hostname, self.port)
 
+    def start_async(self, loop, deliver):
+        # Run the MQTT client on an asyncio event loop, rather than in its own thread
+        # Each decoded event is passed to deliver(), on the event loop. Call maintain() every second or so, to connect and keep alive.
+        self.deliver = deliver
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.client = paho.mqtt.client.Client()
+        self.client.on_message = self.on_message
+        self.client.on_connect = self.on_connect
+        self.client.on_socket_open = lambda client, _, sock: self.on_loop(loop.add_reader, sock, client.loop_read)
+        self.client.on_socket_close = lambda client, _, sock: self.on_loop(loop.remove_reader, sock)
+        self.client.on_socket_register_write = lambda client, _, sock: self.on_loop(loop.add_writer, sock, client.loop_write)
+        self.client.on_socket_unregister_write = lambda client, _, sock: self.on_loop(loop.remove_writer, sock)
+        self.client.connect_async(self.hostname, self.port)
+
+    def on_loop(self, callback, *args):
+        # paho calls back from whichever thread it's in (connecting happens in an executor)
+        # On the loop, run right away: paho closes a socket as soon as on_socket_close returns
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    async def maintain(self):
+        # Connect if we're not connected (blocking, so in an executor), otherwise send keepalives
+        if self.client.socket() is None:
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+            except OSError as e:
+                print("MQTT connect failed:", e, file=sys.stderr)
+        else:
+            self.client.loop_misc()
+
     def on_connect(self, client, _, connect_flags, properties):
         for topic in self.topics:
             self.client.subscribe(topic)
 
     def message2record(self, message, ts=None):
-        if ts is None:
-            ts = datetime.datetime.now(datetime.UTC)
-        if message.topic not in self.topic2sensor:
+        sensor = self.topic2sensor.get(message.topic)
+        if sensor is None:
             print("Unknown topic: ", message.topic, file=sys.stderr)
+            UNKNOWN_TOPICS.inc()
             return
-        i = self.topic2sensor[message.topic]
-        payload = json.loads(message.payload)
-        if "battery" in payload:
-            batt = payload["battery"]
-        else:
-            batt = 0
-        humid = payload["humidity"]
-        linkquality = payload["linkquality"]
-        temp = payload["temperature"]
-        if "voltage" in payload:
-            volt = payload["voltage"]
-        else:
-            volt = 0
-        row = struct.pack("!BBhhHBB",
+        i, row_id = sensor
+        payload = json_loads(message.payload)
+        row = RECORD.pack(
             1,
-            self.sensors[i]["row_id"],
-            int(humid*100),
-            int(temp*100),
-            volt,
-            linkquality,
-            batt, 
+            row_id,
+            int(payload["humidity"]*100),
+            int(payload["temperature"]*100),
+            payload.get("voltage", 0),
+            payload["linkquality"],
+            payload.get("battery", 0),
         )
+        if ts is None:
+            ts = datetime.datetime.now(datetime.UTC)
         return (i, ts, row)
 
     def on_message(self, client, _, message):
         #print("mqtt:", message.topic, file=sys.stderr)
-        record = self.message2record(message)
+        if self.record_file:
+            self.record_file.write(json.dumps({"topic": message.topic, "payload": message.payload.decode('utf8')}) + "\n")
+            self.record_file.flush()
+        MESSAGES.inc()
+        with DECODE_SECONDS.time():
+            record = self.message2record(message)
         if record is None: return
-        self.q.put(record)
+        self.deliver(record)
 
-    def events(self):
-        try:
-            while True:
-                yield self.q.get()
-        #except queue.ShutDown:
-        #    pass
-        except KeyboardInterrupt:
-            self.close()
+    def disconnect(self):
+        # Stop receiving messages
+        self.client.disconnect()
 
     def close(self):
-        self.client.disconnect()
+        self.disconnect()
         self.client.loop_stop()
+        if self.record_file:
+            self.record_file.close()
         #self.q.shutdown(immediate=True)
@@ -0,0 +1,253 @@
+"""
+The ingest pipeline. Each stage runs in its own thread, and they're connected by queues:
+
+    Monitor.q --> writer --> state --> display
+
+The writer drains Monitor.q in batches, and writes each batch to the database with Database.write_many. When records reach disk is up to the database's durability policy; the writer also makes sure a checkpoint that comes due while ingest is idle still happens. The state stage folds events into the State. The display stage renders the reports, coalescing changes as Display.schedule does.
+
+State and Display share a lock, so a slow render holds up State updates, but never persistence or ingest.
+
+On SIGINT or SIGTERM (as from systemctl stop), run() finishes everything already received: it's written and checkpointed, folded into the State, and shown in the reports.
+
+Optionally, run() periodically exports every metric (see metrics.py) to a text file, in the Prometheus exposition format.
+"""
+
+import datetime
+import metrics
+import queue
+import signal
+import sys
+import threading
+import time
+
+STOP = object() # Sentinel passed down the pipeline to shut it down
+
+QUEUE_WAIT_SECONDS = metrics.histogram("monitor_queue_wait_seconds", "Time from MQTT receipt until the writer takes an event off Monitor.q")
+
+class Stage():
+    """Counters for one pipeline stage"""
+    def __init__(self, name, q=None):
+        self.name = name
+        self.q = q
+        self.events = 0
+        self.batches = 0
+        self.busy = 0.0 # Seconds spent working
+        self.last_latency = 0.0 # Seconds from MQTT receipt to the end of this stage, for the last event
+        self.max_latency = 0.0
+        self.latency = metrics.histogram("pipeline_event_latency_seconds", "Time from MQTT receipt to the end of a pipeline stage, per event", stage=name)
+        self.latencies = None # Set to a list to also keep every latency, as for a load test (see bench.py pipeline)
+
+    def done(self, batch, started):
+        now = time.monotonic()
+        self.busy += now - started
+        self.batches += 1
+        self.events += len(batch)
+        if batch:
+            finished = datetime.datetime.now(datetime.UTC)
+            latencies = [(finished - ts).total_seconds() for _, ts, _ in batch]
+            for latency in latencies:
+                self.latency.observe(latency)
+            if self.latencies is not None:
+                self.latencies.extend(latencies)
+            self.last_latency = latencies[-1]
+            self.max_latency = max(self.max_latency, max(latencies))
+
+    def stats(self):
+        return {
+            "depth": self.q.qsize() if self.q is not None else 0,
+            "events": self.events,
+            "batches": self.batches,
+            "busy": self.busy,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+        }
+
+class BasePipeline():
+    """
+    What the threaded Pipeline and aiopipeline.AsyncPipeline share: their settings, and reporting on their stages.
+
+    Subclasses set self.stages, one Stage per stage in order, and implement run().
+    """
+    def __init__(self, monitor, db, state, display, batch_size=100, stats_interval=None, metrics_path=None, metrics_interval=60):
+        self.monitor = monitor
+        self.db = db
+        self.state = state
+        self.display = display
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval # How often run() logs stats to stderr, in seconds
+        self.metrics_path = metrics_path # Where run() exports metrics, every metrics_interval seconds
+        self.metrics_interval = metrics_interval
+        self.stages = []
+        self.error = None # The exception which killed a stage, if any
+
+    def run(self):
+        raise NotImplementedError
+
+    def stats(self):
+        stats = {stage.name: stage.stats() for stage in self.stages}
+        stats["writer"].update(self.db.stats)
+        return stats
+
+    def log_stats(self):
+        print("pipeline: " + ", ".join(
+            "{} depth={} events={} latency={:.3f}s max={:.3f}s busy={:.1f}s".format(
+                name, s["depth"], s["events"], s["last_latency"], s["max_latency"], s["busy"])
+            for name, s in self.stats().items()
+        ) + ", db writes={writes} bytes={bytes} checkpoints={checkpoints}".format(**self.db.stats), file=sys.stderr)
+
+    def export_metrics(self):
+        for stage in self.stages:
+            metrics.gauge("pipeline_queue_depth", "Events waiting for a pipeline stage", stage=stage.name).set(stage.stats()["depth"])
+            metrics.gauge("pipeline_latency_seconds", "Seconds from MQTT receipt to the end of a stage, for the last event", stage=stage.name).set(stage.last_latency)
+        metrics.write(self.metrics_path)
+
+class Pipeline(BasePipeline):
+    def __init__(self, monitor, db, state, display, batch_size=100, stats_interval=None, metrics_path=None, metrics_interval=60):
+        super().__init__(monitor, db, state, display, batch_size, stats_interval, metrics_path, metrics_interval)
+        self.lock = threading.Lock() # Guards state and display
+        self.state_q = queue.Queue()
+        self.display_q = queue.Queue()
+        self.stages = [
+            Stage("writer", monitor.q),
+            Stage("state", self.state_q),
+            Stage("display", self.display_q),
+        ]
+        self.threads = [
+            threading.Thread(target=self.run_stage, args=(self.run_writer,), name="writer"),
+            threading.Thread(target=self.run_stage, args=(self.run_state,), name="state"),
+            threading.Thread(target=self.run_stage, args=(self.run_display,), name="display"),
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        # Finish everything already received, then stop
+        self.monitor.q.put(STOP)
+        if self.error is not None:
+            # A stage died, so STOP may not make it down the pipeline
+            self.state_q.put(STOP)
+            self.display_q.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        # Run until SIGINT or SIGTERM, or until a stage fails
+        # Must be called from the main thread, which handles signals
+        stop_requested = threading.Event()
+        previous = signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+        self.start()
+        next_stats = next_metrics = time.monotonic()
+        try:
+            while all(thread.is_alive() for thread in self.threads) and not stop_requested.is_set():
+                stop_requested.wait(timeout=1)
+                now = time.monotonic()
+                if self.stats_interval and now >= next_stats + self.stats_interval:
+                    self.log_stats()
+                    next_stats = now
+                if self.metrics_path and now >= next_metrics + self.metrics_interval:
+                    self.export_metrics()
+                    next_metrics = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            if self.metrics_path:
+                self.export_metrics()
+            signal.signal(signal.SIGTERM, previous)
+        if self.error is not None:
+            raise RuntimeError("pipeline stage failed") from self.error
+
+    def run_stage(self, target):
+        try:
+            target()
+        except BaseException as e:
+            self.error = e
+            raise
+
+    @staticmethod
+    def get_batch(q, batch_size, timeout=None):
+        # Block for one item, then take whatever else is waiting, up to batch_size
+        # Returns an empty batch on timeout
+        try:
+            batch = [q.get(timeout=timeout)]
+        except queue.Empty:
+            return [], False
+        while len(batch) < batch_size and batch[-1] is not STOP:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+        stop = batch[-1] is STOP
+        if stop:
+            batch.pop()
+        return batch, stop
+
+    def run_writer(self):
+        stage = self.stages[0]
+        while True:
+            batch, stop = self.get_batch(self.monitor.q, self.batch_size, timeout=self.db.checkpoint_due())
+            now = datetime.datetime.now(datetime.UTC)
+            for _, ts, _ in batch:
+                QUEUE_WAIT_SECONDS.observe((now - ts).total_seconds())
+            started = time.monotonic()
+            self.db.write_many(batch) # Also checkpoints, if one is due
+            if stop:
+                self.db.checkpoint()
+
+            stage.done(batch, started)
+            if batch:
+                self.state_q.put(batch)
+            if stop:
+                self.state_q.put(STOP)
+                return
+
+    def run_state(self):
+        stage = self.stages[1]
+        while True:
+            batch = self.state_q.get()
+            if batch is STOP:
+                self.display_q.put(STOP)
+                return
+            started = time.monotonic()
+            with self.lock:
+                for event in batch:
+                    self.display.log(event)
+                    self.state.update(*event)
+                self.state.maybe_save()
+            stage.done(batch, started)
+            self.display_q.put(batch)
+
+    def run_display(self):
+        stage = self.stages[2]
+        pending = [] # Events received, but not yet shown in the reports
+        while True:
+            try:
+                batches = [self.display_q.get(timeout=self.display.wait_time())]
+            except queue.Empty:
+                batches = []
+            while True: # Coalesce
+                try:
+                    batches.append(self.display_q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = STOP in batches
+            batches = [batch for batch in batches if batch is not STOP]
+            for batch in batches:
+                pending.extend(batch)
+
+            started = time.monotonic()
+            with self.lock:
+                if batches:
+                    self.display.schedule(self.state)
+                else:
+                    self.display.flush_due(self.state)
+                if stop:
+                    self.display.flush(self.state)
+                rendered = self.display.wait_time() is None
+            if rendered and pending:
+                stage.done(pending, started)
+                pending = []
+            if stop:
+                return
@@ -1,35 +1,220 @@
+import bisect
+import concurrent.futures
+import database
 import datetime
+import metrics
+import numpy
+import os
+import pickle
 import struct
-import pytz
+import time
 
-EPOCH = datetime.datetime(2024, 1, 1, 0, 0, 0, tzinfo=datetime.UTC)
-TZ = pytz.timezone('US/Eastern')
+from dates import EPOCH, ROWS_PER_HOUR, ts2day, ts2hour, rownum2ts, rownums2days
 
-class RollingTimeseries():
-    def __init__(self, duration=datetime.timedelta(days=2)):
-        self.t = []
-        self.duration = duration
+CADENCE_ROWS = 2 # Sensors should report at least every 10 minutes. Longer silences are gaps.
+HOURLY_KEEP = datetime.timedelta(days=3) # Hourly rollups older than this are dropped. The hourly tier has the full history.
 
-    def add(self, ts, point):
-        now = datetime.datetime.now(datetime.UTC)
-        cutoff = now - self.duration
-        if ts >= cutoff:
-            self.t.append((ts, point))
+# The cache is a pickled snapshot of the summary below. Bump the version
+# whenever the layout of the snapshot changes; a mismatched cache is ignored
+# and the summary is rebuilt from the database.
+CACHE_VERSION = 6
+CACHE_INTERVAL = datetime.timedelta(minutes=10) # How often to re-save the cache while running
 
-    def __iter__(self):
-        self._prune()
-        return iter(self.t)
+UPDATE_SECONDS = metrics.histogram("state_update_seconds", "Time to fold one reading into the summary")
+SAVE_SECONDS = metrics.histogram("state_save_seconds", "Time to save the summary cache")
 
-    def _prune(self):
-        now = datetime.datetime.now(datetime.UTC)
-        cutoff = now - self.duration
-        self.t = [x for x in self.t if x[0] >= cutoff]
+class Rollup():
+    """
+    The low, high, total and count of readings in each bucket (a day or an hour number), for one sensor.
+
+    Stored as numpy arrays covering a run of buckets from base, which grow as needed. Buckets before the first reading take no space, and trim() drops old ones.
+    """
+    def __init__(self):
+        self.base = 0 # Bucket number of the first element of the arrays
+        self.low = numpy.zeros(0)
+        self.high = numpy.zeros(0)
+        self.total = numpy.zeros(0)
+        self.count = numpy.zeros(0, dtype=numpy.int32)
+
+    def _grow(self, start, end):
+        # Make room for buckets [start, end)
+        if len(self.count) == 0:
+            self.base = start
+        old_end = self.base + len(self.count)
+        if start >= self.base and end <= old_end: return
+        base = min(start, self.base)
+        if end > old_end:
+            end = max(end, base + 2*len(self.count)) # Double, so appending is cheap
+        before, after = self.base - base, max(end - old_end, 0)
+        self.low = numpy.concatenate([numpy.full(before, numpy.inf), self.low, numpy.full(after, numpy.inf)])
+        self.high = numpy.concatenate([numpy.full(before, -numpy.inf), self.high, numpy.full(after, -numpy.inf)])
+        self.total = numpy.concatenate([numpy.zeros(before), self.total, numpy.zeros(after)])
+        self.count = numpy.concatenate([numpy.zeros(before, dtype=numpy.int32), self.count, numpy.zeros(after, dtype=numpy.int32)])
+        self.base = base
+
+    def add(self, bucket, x):
+        self._grow(bucket, bucket + 1)
+        i = bucket - self.base
+        self.low[i] = min(self.low[i], x)
+        self.high[i] = max(self.high[i], x)
+        self.total[i] += x
+        self.count[i] += 1
+
+    def add_many(self, buckets, xs):
+        # Vectorized add. Buckets must be sorted, as they are for rows in database order.
+        if len(buckets) == 0: return
+        starts = numpy.flatnonzero(numpy.diff(buckets, prepend=buckets[0]-1))
+        unique = buckets[starts]
+        self._grow(int(unique[0]), int(unique[-1]) + 1)
+        i = unique - self.base
+        self.low[i] = numpy.fmin(self.low[i], numpy.minimum.reduceat(xs, starts))
+        self.high[i] = numpy.fmax(self.high[i], numpy.maximum.reduceat(xs, starts))
+        self.total[i] += numpy.add.reduceat(xs, starts)
+        self.count[i] += numpy.diff(starts, append=len(buckets)).astype(numpy.int32)
+
+    def get(self, bucket):
+        # (low, high, mean, count) for one bucket, or None if it has no readings
+        i = bucket - self.base
+        if not 0 <= i < len(self.count) or self.count[i] == 0:
+            return None
+        count = int(self.count[i])
+        return float(self.low[i]), float(self.high[i]), float(self.total[i]) / count, count
+
+    def buckets(self):
+        # Numbers of the buckets with readings, ascending
+        return numpy.flatnonzero(self.count) + self.base
+
+    def trim(self, start):
+        # Forget the buckets before start
+        drop = min(max(start - self.base, 0), len(self.count))
+        if drop == 0: return
+        self.low, self.high = self.low[drop:].copy(), self.high[drop:].copy()
+        self.total, self.count = self.total[drop:].copy(), self.count[drop:].copy()
+        self.base += drop
+
+class Health():
+    """
+    How well one sensor is reporting: gaps in its readings, and its battery and link quality by local day.
+
+    Maintained as readings come in, so questions about a span of days cost O(days), not a scan of the rows.
+    Reports per day are the counts of the battery rollup, since every reading has a battery level.
+    """
+    def __init__(self):
+        self.batt = Rollup() # By local day
+        self.link = Rollup() # By local day
+        # Gaps are sorted, disjoint [start, end) runs of missing rows, each at least CADENCE_ROWS long
+        self.gap_starts = []
+        self.gap_ends = []
+        self.first = -1 # Oldest row with a reading
+        self.last = -1 # Newest row with a reading
+
+    def add(self, rownum, day, batt, link):
+        self.batt.add(day, batt)
+        self.link.add(day, link)
+        if self.last < 0:
+            self.first = self.last = rownum
+        elif rownum > self.last:
+            if rownum - self.last > CADENCE_ROWS:
+                self.gap_starts.append(self.last + 1)
+                self.gap_ends.append(rownum)
+            self.last = rownum
+        elif rownum < self.first:
+            # Older than any reading so far: the rows up to the old first reading may be a gap
+            if self.first - rownum > CADENCE_ROWS:
+                self.gap_starts.insert(0, rownum + 1)
+                self.gap_ends.insert(0, self.first)
+            self.first = rownum
+        else:
+            self.fill(rownum)
+
+    def add_many(self, rownums, days, batts, links):
+        # Vectorized add, for rows in ascending order after self.last
+        if len(rownums) == 0: return
+        self.batt.add_many(days, batts)
+        self.link.add_many(days, links)
+        if self.last < 0:
+            self.first = int(rownums[0])
+        rows = rownums if self.last < 0 else numpy.concatenate([[self.last], rownums])
+        gaps = numpy.flatnonzero(numpy.diff(rows) > CADENCE_ROWS)
+        self.gap_starts.extend((rows[gaps] + 1).tolist())
+        self.gap_ends.extend(rows[gaps + 1].tolist())
+        self.last = int(rows[-1])
+
+    def fill(self, rownum):
+        # A reading arrived out of order, between the first and last. If it falls in a gap, split the gap around it.
+        i = bisect.bisect_right(self.gap_starts, rownum) - 1
+        if i < 0 or rownum >= self.gap_ends[i]:
+            return
+        start, end = self.gap_starts[i], self.gap_ends[i]
+        del self.gap_starts[i], self.gap_ends[i]
+        # Each side is still a gap if readings on either side of it are too far apart
+        for gap_start, gap_end in reversed([(start, rownum), (rownum + 1, end)]):
+            if gap_end - gap_start >= CADENCE_ROWS:
+                self.gap_starts.insert(i, gap_start)
+                self.gap_ends.insert(i, gap_end)
+
+    def gaps(self, start, end, as_of=None):
+        # The gaps which overlap rows [start, end), as a list of [start, end) runs
+        # As of a given row, the silence since the newest reading is a gap too, if it's already long enough
+        i = bisect.bisect_right(self.gap_ends, start)
+        j = bisect.bisect_left(self.gap_starts, end)
+        gaps = list(zip(self.gap_starts[i:j], self.gap_ends[i:j]))
+        if as_of is not None and self.last >= 0 and as_of - self.last > CADENCE_ROWS and self.last + 1 < end and as_of > start:
+            gaps.append((self.last + 1, as_of))
+        return gaps
+
+    def silence(self, rownum):
+        # Rows since the newest reading, as of a given row. None if there's never been a reading.
+        return rownum - self.last if self.last >= 0 else None
+
+    def days(self, start, end):
+        # For each local day in [start, end): (reports, battery low, battery mean, link low, link mean), or None for no reports
+        days = []
+        for day in range(start, end):
+            batt, link = self.batt.get(day), self.link.get(day)
+            days.append((batt[3], batt[0], batt[2], link[0], link[2]) if batt else None)
+        return days
+
+def oldest_hour():
+    # The oldest hour kept in the hourly rollups
+    return ts2hour(datetime.datetime.now(datetime.UTC) - HOURLY_KEEP)
+
+def summarize(rownums, records, daily, hourly, health):
+    # Fold one sensor's rows (ascending, after any already folded in) into its summary
+    # Returns the newest reading, as (temp, humid, last_update, last_rownum)
+    humids = records["humid"] / 100
+    temps = records["temp"] / 100
+    days = rownums2days(rownums)
+
+    daily.add_many(days, temps)
+    hours = rownums // ROWS_PER_HOUR
+    recent = hours >= oldest_hour()
+    hourly.add_many(hours[recent], temps[recent])
+    health.add_many(rownums, days, records["batt"].astype(numpy.float64), records["linkquality"].astype(numpy.float64))
+    return float(temps[-1]), float(humids[-1]), rownum2ts(int(rownums[-1])), int(rownums[-1])
+
+worker_db = None # Each worker process of load_from_db_parallel opens the database once
+
+def open_worker_db(path):
+    global worker_db
+    worker_db = database.Database(None, path, readonly=True)
+
+def summarize_sensor(sensor):
+    # Run in a worker: the whole summary of one sensor, built from scratch
+    daily, hourly, health = Rollup(), Rollup(), Health()
+    rownums, records = worker_db.read_arrays(sensor)
+    newest = summarize(rownums, records, daily, hourly, health) if len(rownums) else None
+    return sensor, newest, daily, hourly, health
 
 class State():
-    def __init__(self, db, path=None):
+    def __init__(self, db, path=None, workers=1):
         if path is None: path = db.path + ".cache"
+        self.path = path
+        self.db = db
+        self.timings = {} # Seconds spent in each part of startup
+        started = time.perf_counter()
 
-        self.db_metadata = db.get_all_metadata()
+        self.db_metadata = db.metadata
         self.num_sensors = len(self.db_metadata)
         sensors = range(self.num_sensors)
 
@@ -37,46 +222,123 @@ class State():
         self.temps = [0 for _ in sensors]
         self.humid = [0 for _ in sensors]
         self.last_update = [EPOCH for _ in sensors]
-        # TODO
-        self.highs = [{} for _ in sensors]
-        self.lows = [{} for _ in sensors]
-        self.timeseries = [RollingTimeseries() for _ in sensors] # Cover the last 24 hours
+        self.last_rownum = [-1 for _ in sensors] # Last database row folded into the summary
+        self.daily = [Rollup() for _ in sensors] # By local day, see date2day
+        self.hourly = [Rollup() for _ in sensors] # By hour since EPOCH, for the last HOURLY_KEEP
+        self.health = [Health() for _ in sensors]
+
+        # Load from cache, then replay anything written since the cache was saved
+        cached = self.load_from_cache()
+        started = metrics.timed(self.timings, "cache", started)
+        if cached:
+            now = datetime.datetime.now(datetime.UTC)
+            self.load_from_db(db, end=db.ts2rownum(now)+1)
+        elif workers > 1:
+            self.load_from_db_parallel(db, workers)
+        else:
+            self.load_from_db(db)
+        started = metrics.timed(self.timings, "replay" if cached else "rebuild", started)
+        self.save()
+        metrics.timed(self.timings, "save", started)
+
+    def load_from_db(self, db, end=None):
+        # Fold in rows after the last row already in the summary, one sensor at a time, in bulk
+        for sensor in range(self.num_sensors):
+            start = self.last_rownum[sensor] + 1
+            if end is None:
+                rownums, records = db.read_arrays(sensor, start)
+            else:
+                rownums, records = db.read_arrays(sensor, start, end)
+            if len(rownums) == 0:
+                continue
+            newest = summarize(rownums, records, self.daily[sensor], self.hourly[sensor], self.health[sensor])
+            self.temps[sensor], self.humid[sensor], self.last_update[sensor], self.last_rownum[sensor] = newest
 
-        # TODO: Load from cache
-        self.load_from_db(db)
+    def load_from_db_parallel(self, db, workers):
+        # Build the summary from scratch, one sensor per worker process
+        # Processes, not threads: the numpy passes are short, and the Python between them holds the GIL
+        # Workers open the database read-only, so it must be committed (as it is at boot)
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=open_worker_db, initargs=(db.path,)) as pool:
+            for sensor, newest, daily, hourly, health in pool.map(summarize_sensor, range(self.num_sensors)):
+                self.daily[sensor], self.hourly[sensor], self.health[sensor] = daily, hourly, health
+                if newest is not None:
+                    self.temps[sensor], self.humid[sensor], self.last_update[sensor], self.last_rownum[sensor] = newest
 
-    def load_from_db(self, db):
-        for e in db.read_all():
-            self.update(*e)
+    def load_from_cache(self):
+        # Returns whether a usable cache was loaded
+        try:
+            with open(self.path, "rb") as f:
+                cache = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        if cache.get("version") != CACHE_VERSION or cache["metadata"] != self.db_metadata:
+            return False
+
+        self.temps = cache["temps"]
+        self.humid = cache["humid"]
+        self.last_update = cache["last_update"]
+        self.last_rownum = cache["last_rownum"]
+        self.daily = cache["daily"]
+        self.hourly = cache["hourly"]
+        self.health = cache["health"]
+        return True
+
+    def save(self):
+        # Atomically replace the cache with a snapshot of the current summary
+        with SAVE_SECONDS.time():
+            self._save()
+
+    def _save(self):
+        for hourly in self.hourly:
+            hourly.trim(oldest_hour())
+        cache = {
+            "version": CACHE_VERSION,
+            "metadata": self.db_metadata,
+            "temps": self.temps,
+            "humid": self.humid,
+            "last_update": self.last_update,
+            "last_rownum": self.last_rownum,
+            "daily": self.daily,
+            "hourly": self.hourly,
+            "health": self.health,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.saved_at = datetime.datetime.now(datetime.UTC)
 
     def sensors(self):
         return self.db_metadata
 
     def update(self, sensor, ts, record):
-        # Load the data
-        version, row_id, humid, temp, volt, linkquality, batt = struct.unpack("!BBhhHBB", record)
-        humid /= 100
-        temp /= 100
-        
-        self._update(sensor, ts, humid, temp)
-
-    def _update(self, sensor, ts, humid, temp):
+        with UPDATE_SECONDS.time():
+            # Load the data
+            version, row_id, humid, temp, volt, linkquality, batt = struct.unpack("!BBhhHBB", record)
+            humid /= 100
+            temp /= 100
+
+            rownum = self.db.ts2rownum(ts)
+            self._update(sensor, ts, rownum, humid, temp, batt, linkquality)
+            self.last_rownum[sensor] = max(self.last_rownum[sensor], rownum)
+
+    def _update(self, sensor, ts, rownum, humid, temp, batt, linkquality):
         self.temps[sensor] = temp
         self.humid[sensor] = humid
         self.last_update[sensor] = ts
 
-        date = ts.astimezone(TZ).date()
-        if date not in self.highs[sensor]:
-            self.highs[sensor][date] = temp
-        else:
-            self.highs[sensor][date] = max(self.highs[sensor][date], temp)
-        if date not in self.lows[sensor]:
-            self.lows[sensor][date] = temp
-        else:
-            self.lows[sensor][date] = min(self.lows[sensor][date], temp)
+        day = ts2day(ts)
+        self.health[sensor].add(rownum, day, batt, linkquality)
+        self.daily[sensor].add(day, temp)
+        self.hourly[sensor].add(rownum // ROWS_PER_HOUR, temp)
 
-        self.timeseries[sensor].add(ts, temp)
+    def maybe_save(self):
+        # Save the cache if it's gotten old, so a crash doesn't lose much
+        now = datetime.datetime.now(datetime.UTC)
+        if now - self.saved_at >= CACHE_INTERVAL:
+            self.save()
 
     def close(self):
-        # TODO: Save to cache
-        pass
+        self.save()
@@ -0,0 +1,35 @@
+import datetime
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate
+
+# A small synthetic database, ending just after a DST change, so it has local days of 23 and 25 hours
+END = datetime.datetime(2025, 3, 20, tzinfo=datetime.UTC)
+
+@pytest.fixture(scope="session")
+def synthetic_db(tmp_path_factory):
+    # Path of a synthetic database: 4 sensors, 6 months of readings every 10 minutes, with dropouts
+    # Shared by the tests, so don't write to it. Copy it with copy_db.
+    path = str(tmp_path_factory.mktemp("synthetic") / "temps.db")
+    generate.generate(path, sensors=4, years=0.5, dropout=0.05, interval=10, end=END, seed=1)
+    return path
+
+def copy_db(path, new_path):
+    # Copy a database file, sparsely, without its index or tiers
+    with open(path, "rb") as f, open(new_path, "wb") as g:
+        g.truncate(os.fstat(f.fileno()).st_size)
+        while True:
+            offset = f.tell()
+            try:
+                offset = os.lseek(f.fileno(), offset, os.SEEK_DATA)
+            except OSError:
+                break # No more data
+            hole = os.lseek(f.fileno(), offset, os.SEEK_HOLE)
+            f.seek(offset)
+            g.seek(offset)
+            g.write(f.read(hole - offset))
@@ -0,0 +1,65 @@
+import datetime
+import filecmp
+import struct
+
+import numpy
+import pytest
+
+import archive
+import database
+import main
+from dates import ts2rownum
+
+def record(temp):
+    return struct.pack("!BBhhHBB", 1, 10, 4500, temp, 3000, 120, 90)
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_round_trip(synthetic_db, tmp_path, codec):
+    # Export then import gives a byte-identical database, and the same rollup tiers
+    path = str(tmp_path / "temps.archive")
+    archive.export_archive(synthetic_db, path, codec)
+    imported = str(tmp_path / "temps.db")
+    archive.import_archive(path, imported)
+    for suffix in ["", ".hourly", ".daily", ".monthly"]:
+        assert filecmp.cmp(synthetic_db + suffix, imported + suffix, shallow=False), suffix
+
+def test_months(synthetic_db, tmp_path):
+    # Each month can be read by itself, and holds the rows of that month
+    path = str(tmp_path / "temps.archive")
+    archive.export_archive(synthetic_db, path)
+    db = database.Database(None, synthetic_db, readonly=True)
+    arc = archive.Archive(path)
+    assert arc.sensors() == db.metadata
+    for sensor in range(db.count_sensors()):
+        months = arc.months(sensor)
+        assert len(months) == 7 # Six months of readings, not aligned to month boundaries
+        for month in months:
+            start, end = archive.MONTH_STARTS[month], archive.MONTH_STARTS[month + 1]
+            rownums, records = arc.read(sensor, month)
+            expected_rownums, expected_records = db.read_arrays(sensor, start, end)
+            assert numpy.array_equal(rownums, expected_rownums)
+            assert numpy.array_equal(records, expected_records)
+    assert archive.parse_month("2025-03") in arc.months(0)
+    arc.close()
+    db.close()
+
+def test_after_crash(tmp_path):
+    # Rows the writer wrote but never checkpointed, as after a crash, are exported too
+    db_path = str(tmp_path / "crashed.db")
+    now = ts2rownum(datetime.datetime.now(datetime.UTC))
+    db = database.Database(main.SENSORS[:2], db_path)
+    db.write_rownum(0, now - 5000, record(2100))
+    db.checkpoint()
+    db.write_rownum(0, now - 1, record(2200))
+    db.write_rownum(1, now, record(2300)) # A sensor with nothing in the index
+    db.f.flush() # Reached the file, but the index was never saved
+
+    path = str(tmp_path / "temps.archive")
+    archive.export_archive(db_path, path)
+    imported = str(tmp_path / "imported.db")
+    archive.import_archive(path, imported)
+    assert filecmp.cmp(db_path, imported, shallow=False)
+    db = database.Database(None, imported, readonly=True)
+    assert db.read_arrays(0)[0].tolist() == [now - 5000, now - 1]
+    assert db.read_arrays(1)[0].tolist() == [now]
+    db.close()
@@ -0,0 +1,89 @@
+import datetime
+import json
+import struct
+
+import database
+import main
+from database import BLOCK_ROWS, METADATA_LENGTH, SENSOR_LENGTH, Occupancy
+from dates import ROWS_PER_HOUR, ts2rownum, rownum2ts
+
+def record(temp, row_id=10):
+    return struct.pack("!BBhhHBB", 1, row_id, 4500, temp, 3000, 120, 90)
+
+def test_record_format(tmp_path):
+    path = str(tmp_path / "temps.db")
+    db = database.Database(main.SENSORS[:2], path)
+    ts = datetime.datetime(2025, 1, 2, 3, 5, tzinfo=datetime.UTC)
+    db.write_ts(1, ts, record(2150, row_id=2))
+    db.close()
+
+    with open(path, "rb") as f:
+        data = f.read()
+    assert len(data) == 2*SENSOR_LENGTH
+    header = data[SENSOR_LENGTH:SENSOR_LENGTH + METADATA_LENGTH]
+    assert header.rstrip(b"\0").decode("utf8") == "1\n" + json.dumps([1, main.SENSORS[1]]) + "\n"
+    rownum = ts2rownum(ts)
+    offset = SENSOR_LENGTH + METADATA_LENGTH + rownum*10
+    assert data[offset:offset + 10] == record(2150, row_id=2)
+    assert data[offset - 10:offset] == bytes(10) and data[offset + 10:offset + 20] == bytes(10)
+
+    db = database.Database(None, path, readonly=True)
+    assert db.metadata == main.SENSORS[:2]
+    assert db.read_ts(1, ts) == (1, ts, record(2150, row_id=2))
+    rownums, records = db.read_arrays(1)
+    assert rownums.tolist() == [rownum]
+    assert records[0]["temp"] == 2150 and records[0]["humid"] == 4500 and records[0]["row_id"] == 2
+    db.close()
+
+def test_occupancy():
+    occupancy = Occupancy()
+    for rownum in [5*BLOCK_ROWS + 3, 7*BLOCK_ROWS, 2*BLOCK_ROWS + 1, 6*BLOCK_ROWS + 9, 5*BLOCK_ROWS]:
+        occupancy.add(rownum)
+    assert occupancy.runs == [[2, 3], [5, 8]]
+    assert occupancy.hwm == 7*BLOCK_ROWS
+    # Ranges stop after the newest row
+    assert list(occupancy.ranges()) == [(2*BLOCK_ROWS, 3*BLOCK_ROWS), (5*BLOCK_ROWS, 7*BLOCK_ROWS + 1)]
+    assert list(occupancy.ranges(2*BLOCK_ROWS + 5, 5*BLOCK_ROWS + 1)) == [(2*BLOCK_ROWS + 5, 3*BLOCK_ROWS), (5*BLOCK_ROWS, 5*BLOCK_ROWS + 1)]
+
+def test_index_format(tmp_path):
+    path = str(tmp_path / "temps.db")
+    db = database.Database(main.SENSORS[:2], path)
+    for rownum in [3*BLOCK_ROWS + 7, 4*BLOCK_ROWS, 9*BLOCK_ROWS + 1]:
+        db.write_rownum(0, rownum, record(2000))
+    db.close()
+
+    with open(path + ".index") as f:
+        lines = f.read().splitlines()
+    assert json.loads(lines[0]) == database.INDEX_VERSION
+    assert set(json.loads(lines[1])) == {"mtime_ns"}
+    assert [json.loads(line) for line in lines[2:]] == [
+        {"runs": [[3, 5], [9, 10]], "hwm": 9*BLOCK_ROWS + 1},
+        {"runs": [], "hwm": -1},
+    ]
+
+def test_index_matches_file(synthetic_db):
+    # The index saved alongside the database is the same as one rebuilt by scanning it
+    db = database.Database(None, synthetic_db, readonly=True)
+    for sensor in range(db.count_sensors()):
+        scanned = Occupancy.from_records(db.records(sensor))
+        assert db.occupancy[sensor].runs == scanned.runs
+        assert db.occupancy[sensor].hwm == scanned.hwm
+    db.close()
+
+def test_index_after_crash(tmp_path):
+    # Rows written after the last checkpoint are found when the database is next opened
+    path = str(tmp_path / "temps.db")
+    now = ts2rownum(datetime.datetime.now(datetime.UTC))
+    db = database.Database(main.SENSORS[:1], path)
+    db.write_rownum(0, now - 10*BLOCK_ROWS, record(1900))
+    db.checkpoint()
+    db.write_rownum(0, now - 1, record(2000))
+    db.f.flush() # Reached the file, but the index was never saved: a crash
+
+    db = database.Database(main.SENSORS[:1], path)
+    assert db.occupancy[0].hwm == now - 1
+    rownums, records = db.read_arrays(0)
+    assert rownums.tolist() == [now - 10*BLOCK_ROWS, now - 1]
+    hour = rownum2ts((now - 1) // ROWS_PER_HOUR * ROWS_PER_HOUR)
+    assert db.read_tier("hourly", 0, hour)[1]["total"].tolist() == [2000]
+    db.close()
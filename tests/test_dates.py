@@ -0,0 +1,35 @@
+import datetime
+
+import numpy
+
+from dates import EPOCH, ROWS_PER_HOUR, SENSOR_ROWS, TZ, ts2day, ts2rownum, rownum2ts, rownums2days
+
+def check(rownums):
+    expected = [ts2day(rownum2ts(rownum)) for rownum in rownums]
+    assert rownums2days(numpy.array(rownums, dtype=numpy.int64)).tolist() == expected
+
+def test_transitions():
+    # rownums2days reads pytz's own transition table. Check it against astimezone on both sides of every DST change.
+    transitions = [ts.replace(tzinfo=datetime.UTC) for ts in TZ._utc_transition_times]
+    transitions = [ts for ts in transitions if EPOCH <= ts < rownum2ts(SENSOR_ROWS)]
+    assert len(transitions) > 20 # Twice a year, until pytz's table ends in 2037
+    rownums = []
+    for ts in transitions:
+        rownum = ts2rownum(ts)
+        assert rownum2ts(rownum) == ts # Transitions fall on row boundaries
+        for offset in [-ROWS_PER_HOUR, -1, 0, 1, ROWS_PER_HOUR]:
+            rownums.append(rownum + offset)
+    check(rownums)
+
+def test_local_midnights():
+    # Around local midnight on days with and without DST changes
+    rownums = []
+    for date in [datetime.date(2024, 1, 1), datetime.date(2024, 3, 10), datetime.date(2024, 11, 3), datetime.date(2025, 6, 1)]:
+        midnight = ts2rownum(TZ.localize(datetime.datetime.combine(date, datetime.time())).astimezone(datetime.UTC))
+        rownums.extend(range(midnight - 2, midnight + 2))
+    check(rownums)
+
+def test_every_hour():
+    # Every hour of 2024, and both ends of the database
+    rownums = list(range(0, 366*24*ROWS_PER_HOUR, ROWS_PER_HOUR)) + [SENSOR_ROWS - 1]
+    check(rownums)
@@ -0,0 +1,122 @@
+import datetime
+import pickle
+import struct
+
+import numpy
+
+import database
+import main
+import state
+from conftest import copy_db
+from dates import ROWS_PER_HOUR, rownum2ts, ts2rownum
+
+def assert_same_summary(a, b):
+    assert a.num_sensors == b.num_sensors
+    assert a.temps == b.temps and a.humid == b.humid
+    assert a.last_update == b.last_update and a.last_rownum == b.last_rownum
+    for sensor in range(a.num_sensors):
+        for x, y in [
+            (a.daily[sensor], b.daily[sensor]),
+            (a.hourly[sensor], b.hourly[sensor]),
+            (a.health[sensor].batt, b.health[sensor].batt),
+            (a.health[sensor].link, b.health[sensor].link),
+        ]:
+            assert x.buckets().tolist() == y.buckets().tolist()
+            assert [x.get(bucket) for bucket in x.buckets().tolist()] == [y.get(bucket) for bucket in y.buckets().tolist()]
+        assert a.health[sensor].gap_starts == b.health[sensor].gap_starts
+        assert a.health[sensor].gap_ends == b.health[sensor].gap_ends
+        assert a.health[sensor].last == b.health[sensor].last
+
+def test_parallel(synthetic_db, tmp_path):
+    # Rebuilding the summary in worker processes gives the same summary as the serial rebuild
+    db = database.Database(None, synthetic_db, readonly=True)
+    serial = state.State(db, path=str(tmp_path / "serial.cache"))
+    parallel = state.State(db, path=str(tmp_path / "parallel.cache"), workers=3)
+    assert "rebuild" in serial.timings and "rebuild" in parallel.timings
+    assert_same_summary(serial, parallel)
+    assert serial.last_rownum[0] > 0 and len(serial.daily[0].buckets()) > 150
+    db.close()
+
+def test_cache(synthetic_db, tmp_path):
+    db = database.Database(None, synthetic_db, readonly=True)
+    path = str(tmp_path / "temps.db.cache")
+    built = state.State(db, path=path)
+    with open(path, "rb") as f:
+        cache = pickle.load(f)
+    assert cache["version"] == state.CACHE_VERSION
+    assert cache["metadata"] == db.metadata
+    assert set(cache) == {"version", "metadata", "temps", "humid", "last_update", "last_rownum", "daily", "hourly", "health"}
+
+    loaded = state.State(db, path=path)
+    assert "cache" in loaded.timings and "replay" in loaded.timings and "rebuild" not in loaded.timings
+    assert_same_summary(built, loaded)
+
+    # A cache of another version is ignored
+    cache["version"] -= 1
+    with open(path, "wb") as f:
+        pickle.dump(cache, f)
+    assert "rebuild" in state.State(db, path=path).timings
+    db.close()
+
+def test_replay(synthetic_db, tmp_path):
+    # Rows written after the cache was saved are folded in on the next boot, as if the summary had been built from scratch
+    path = str(tmp_path / "temps.db")
+    copy_db(synthetic_db, path)
+    db = database.Database(main.SENSORS[:4], path)
+    state.State(db).close()
+
+    now = ts2rownum(datetime.datetime.now(datetime.UTC))
+    rownums = list(range(now - 3*24*ROWS_PER_HOUR, now, 7))
+    db.write_many([(rownum % 4, rownum2ts(rownum), struct.pack("!BBhhHBB", 1, 0, 5000, rownum % 3000, 3000, 100, 80)) for rownum in rownums])
+    db.checkpoint()
+
+    replayed = state.State(db)
+    assert "replay" in replayed.timings
+    rebuilt = state.State(db, path=str(tmp_path / "rebuilt.cache"))
+    assert "rebuild" in rebuilt.timings
+    assert_same_summary(replayed, rebuilt)
+    assert len(replayed.hourly[0].buckets()) > 0
+    db.close()
+
+def test_rollup():
+    rollup = state.Rollup()
+    rollup.add_many(numpy.array([100, 100, 102]), numpy.array([1.0, 3.0, 2.0]))
+    rollup.add(98, 5.0)
+    rollup.add(102, -1.0)
+    assert rollup.buckets().tolist() == [98, 100, 102]
+    assert rollup.get(100) == (1.0, 3.0, 2.0, 2)
+    assert rollup.get(102) == (-1.0, 2.0, 0.5, 2)
+    assert rollup.get(99) is None and rollup.get(0) is None and rollup.get(1000) is None
+    rollup.trim(101)
+    assert rollup.buckets().tolist() == [102]
+    assert rollup.get(100) is None and rollup.get(102) == (-1.0, 2.0, 0.5, 2)
+
+def expected_gaps(rownums):
+    rownums = sorted(set(rownums))
+    return [(a + 1, b) for a, b in zip(rownums, rownums[1:]) if b - a > state.CADENCE_ROWS]
+
+def add(health, rownums):
+    for rownum in rownums:
+        health.add(rownum, rownum // 100, 50.0, 100.0)
+
+def test_health_gaps():
+    health = state.Health()
+    add(health, [11, 1, 4, 7, 20])
+    assert list(zip(health.gap_starts, health.gap_ends)) == [(2, 4), (5, 7), (8, 11), (12, 20)]
+    assert health.first == 1 and health.last == 20
+    assert health.gaps(0, 6) == [(2, 4), (5, 7)]
+    assert health.gaps(21, 30, as_of=30) == [(21, 30)]
+
+    # Readings in any order, including repeats, give the same gaps as the sorted readings
+    rnd = numpy.random.default_rng(0)
+    for _ in range(300):
+        rownums = rnd.choice(300, int(rnd.integers(1, 100))).tolist()
+        health = state.Health()
+        add(health, rownums)
+        assert list(zip(health.gap_starts, health.gap_ends)) == expected_gaps(rownums)
+        assert (health.first, health.last) == (min(rownums), max(rownums))
+
+        in_order = state.Health()
+        rownums = numpy.unique(rownums)
+        in_order.add_many(rownums, rownums // 100, numpy.full(len(rownums), 50.0), numpy.full(len(rownums), 100.0))
+        assert list(zip(in_order.gap_starts, in_order.gap_ends)) == expected_gaps(rownums.tolist())
@@ -0,0 +1,76 @@
+import datetime
+import os
+import struct
+
+import numpy
+
+import database
+import main
+import tiers
+from conftest import copy_db
+from dates import ROWS_PER_HOUR, day2date, rownum2ts, rownums2days, ts2rownum
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def tier_files(path):
+    return {name: read_file("{}.{}".format(path, name)) for name in ["hourly", "daily", "monthly"]}
+
+def test_incremental_matches_rebuild(tmp_path):
+    # Tiers kept up to date as rows are written, including rewritten rows, are the same as tiers rebuilt from scratch
+    path = str(tmp_path / "temps.db")
+    db = database.Database(main.SENSORS[:3], path, checkpoint_rows=500)
+    rnd = numpy.random.default_rng(0)
+    start = ts2rownum(datetime.datetime(2024, 10, 20, tzinfo=datetime.UTC)) # Over the end of DST
+    rownums = start + numpy.sort(rnd.choice(40*24*ROWS_PER_HOUR, 3000, replace=False))
+    for batch in numpy.array_split(rownums, 30):
+        events = []
+        for rownum in batch.tolist():
+            sensor = rownum % 3
+            temp = int(rnd.integers(-1000, 3000))
+            events.append((sensor, rownum2ts(rownum), struct.pack("!BBhhHBB", 1, sensor, 5000, temp, 3000, 100, 80)))
+        db.write_many(events)
+    # Rewrite some rows, which must replace their old readings in the rollups rather than add to them
+    for rownum in rownums[::50].tolist():
+        db.write_rownum(rownum % 3, rownum, struct.pack("!BBhhHBB", 1, 0, 5000, 4000, 3000, 100, 80))
+    db.close()
+
+    copy = str(tmp_path / "copy.db")
+    copy_db(path, copy)
+    database.Database(main.SENSORS[:3], copy).close() # No tiers yet, so they're built from the file
+    assert tier_files(copy) == tier_files(path)
+
+    # Rebuilding over existing tiers gives the same files again
+    db = database.Database(main.SENSORS[:3], path)
+    db.tiers.rebuild(db)
+    db.close()
+    assert tier_files(copy) == tier_files(path)
+
+def test_rollups(synthetic_db):
+    # Each tier holds the low, high, total and count of the raw readings in its buckets
+    db = database.Database(None, synthetic_db, readonly=True)
+    for sensor in range(db.count_sensors()):
+        rownums, records = db.read_arrays(sensor)
+        temps = records["temp"].astype(numpy.int64)
+        days = rownums2days(rownums)
+        months = numpy.array([tiers.date2month(day2date(day)) for day in days.tolist()])
+        for name, buckets in [("hourly", rownums // ROWS_PER_HOUR), ("daily", days), ("monthly", months)]:
+            unique, index = numpy.unique(buckets, return_inverse=True)
+            found, rollups = db.read_tier(name, sensor)
+            assert found.tolist() == unique.tolist()
+            assert rollups["count"].tolist() == numpy.bincount(index).tolist()
+            assert rollups["total"].tolist() == numpy.bincount(index, weights=temps).astype(numpy.int64).tolist()
+            low, high = numpy.full(len(unique), 1 << 20), numpy.full(len(unique), -1 << 20)
+            numpy.minimum.at(low, index, temps)
+            numpy.maximum.at(high, index, temps)
+            assert rollups["low"].tolist() == low.tolist() and rollups["high"].tolist() == high.tolist()
+    db.close()
+
+def test_lost_tiers(synthetic_db, tmp_path):
+    # A database whose index and tiers were lost gets them back as they were
+    copy = str(tmp_path / "copy.db")
+    copy_db(synthetic_db, copy)
+    database.Database(main.SENSORS[:4], copy).close()
+    assert tier_files(copy) == tier_files(synthetic_db)
+    assert os.path.exists(copy + ".index")
@@ -0,0 +1,250 @@
+"""
+Downsampled rollups of the temperature database, kept in files next to it: temps.db.hourly, temps.db.daily and temps.db.monthly.
+
+Like the main file, each tier is one fixed-size section per sensor, preallocated (sparse) to cover the same 64 years. There is no header. Each section is an array of fixed-size records, one per bucket (hour, day or month).
+
+The format of a rollup record is these 10 bytes:
+
+|_____|_____|_____|_____|_____|_____|_____|_____|_____|_____| Byte
+|Low        |High       |Total                  |Count      | Field
+ 0.01C       0.01C       0.01C                   readings    Units
+
+The mean is Total/Count. A count of 0 means no data.
+
+Hourly buckets are UTC hours since EPOCH. Daily and monthly buckets are local (US/Eastern) days and months, numbered from the local date of EPOCH.
+
+Tiers are derived data: they can always be rebuilt from the main file. Each bucket is recomputed from the tier below it (raw rows for hours, hours for days, days for months), so rewriting a row never double-counts.
+"""
+
+import datetime
+import mmap
+import numpy
+import os
+import os.path
+
+from dates import EPOCH, TZ, START_DATE, ROW_SECONDS, ROWS_PER_HOUR, SENSOR_ROWS, date2day, day2date, ts2hour, rownums2days
+
+TIER_DTYPE = numpy.dtype([
+    ("low", ">i2"),
+    ("high", ">i2"),
+    ("total", ">i4"),
+    ("count", ">u2"),
+])
+assert TIER_DTYPE.itemsize == 10
+
+def local_midnight(date):
+    return TZ.localize(datetime.datetime.combine(date, datetime.time())).astimezone(datetime.UTC)
+
+def month2date(month):
+    # The first day of a month number
+    months = START_DATE.month - 1 + month
+    return datetime.date(START_DATE.year + months // 12, months % 12 + 1, 1)
+
+def date2month(date):
+    return (date.year - START_DATE.year)*12 + date.month - START_DATE.month
+
+def combine(buckets, low, high, total, count):
+    # Merge rollups (or single readings) into their parent buckets, which must be sorted
+    # Returns (buckets, low, high, total, count) with one entry per distinct bucket
+    starts = numpy.flatnonzero(numpy.diff(buckets, prepend=buckets[0]-1))
+    return (
+        buckets[starts],
+        numpy.minimum.reduceat(low, starts),
+        numpy.maximum.reduceat(high, starts),
+        numpy.add.reduceat(total, starts),
+        numpy.add.reduceat(count, starts),
+    )
+
+class Tier():
+    name = None
+    buckets = None # Buckets per sensor
+
+    def __init__(self, db_path, num_sensors, readonly=False):
+        self.path = "{}.{}".format(db_path, self.name)
+        self.section_length = self.buckets * TIER_DTYPE.itemsize
+        if readonly:
+            self.created = False
+            self.f = open(self.path, "rb")
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            return
+        self.created = not os.path.exists(self.path)
+        self.f = open(self.path, "w+b" if self.created else "r+b")
+        # Sparse: untouched buckets cost no disk space
+        if os.fstat(self.f.fileno()).st_size < self.section_length * num_sensors:
+            self.f.truncate(self.section_length * num_sensors)
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+
+    def records(self, sensor, start=0, end=None):
+        # A view of buckets [start, end) for one sensor. Writable, unless the tier is read-only.
+        if end is None: end = self.buckets
+        start, end = max(start, 0), min(end, self.buckets)
+        return numpy.frombuffer(self.mm, dtype=TIER_DTYPE, count=max(end - start, 0),
+            offset=self.section_length*sensor + start*TIER_DTYPE.itemsize)
+
+    def write(self, sensor, buckets, low, high, total, count):
+        # Store rollups for the given (sorted) buckets
+        if len(buckets) == 0: return
+        records = self.records(sensor, int(buckets[0]), int(buckets[-1]) + 1)
+        i = buckets - buckets[0]
+        records["low"][i] = low
+        records["high"][i] = high
+        records["total"][i] = total
+        records["count"][i] = count
+
+    def read(self, sensor, start=0, end=None):
+        # The non-empty buckets in [start, end), as (buckets, records) arrays
+        records = self.records(sensor, start, end)
+        buckets = numpy.flatnonzero(records["count"])
+        return buckets + max(start, 0), records[buckets]
+
+    def bucket2ts(self, bucket):
+        # When a bucket starts
+        raise NotImplementedError
+
+    def ts2bucket(self, ts):
+        # The bucket holding ts
+        raise NotImplementedError
+
+    def child_span(self, bucket):
+        # The [start, end) buckets of the tier below (or raw rows) that make up one bucket
+        raise NotImplementedError
+
+    def parents(self, children):
+        # The bucket of each (sorted) child bucket or row, vectorized
+        raise NotImplementedError
+
+    def close(self):
+        try:
+            self.mm.close()
+        except BufferError:
+            pass # A records() view is still alive; the map is released along with it
+        self.f.close()
+
+class HourlyTier(Tier):
+    name = "hourly"
+    buckets = SENSOR_ROWS // ROWS_PER_HOUR
+
+    def bucket2ts(self, bucket):
+        return EPOCH + datetime.timedelta(hours=bucket)
+
+    def ts2bucket(self, ts):
+        return ts2hour(ts)
+
+    def child_span(self, bucket):
+        return bucket*ROWS_PER_HOUR, (bucket+1)*ROWS_PER_HOUR
+
+    def parents(self, rownums):
+        return rownums // ROWS_PER_HOUR
+
+class DailyTier(Tier):
+    name = "daily"
+    buckets = SENSOR_ROWS*ROW_SECONDS // 86400 + 2 # The local dates overlap EPOCH's by a day at each end
+
+    def bucket2ts(self, bucket):
+        return local_midnight(day2date(bucket))
+
+    def ts2bucket(self, ts):
+        return date2day(ts.astimezone(TZ).date())
+
+    def child_span(self, bucket):
+        # US/Eastern offsets are whole hours, so local days are runs of UTC hours
+        return ts2hour(self.bucket2ts(bucket)), ts2hour(self.bucket2ts(bucket+1))
+
+    def parents(self, hours):
+        return rownums2days(hours * ROWS_PER_HOUR)
+
+class MonthlyTier(Tier):
+    name = "monthly"
+    buckets = 64*12 + 2
+
+    def bucket2ts(self, bucket):
+        return local_midnight(month2date(bucket))
+
+    def ts2bucket(self, ts):
+        return date2month(ts.astimezone(TZ).date())
+
+    def child_span(self, bucket):
+        return date2day(month2date(bucket)), date2day(month2date(bucket+1))
+
+    def parents(self, days):
+        unique, index = numpy.unique(days, return_inverse=True)
+        months = numpy.array([date2month(day2date(day)) for day in unique.tolist()], dtype=numpy.int64)
+        return months[index]
+
+class Tiers():
+    """The hourly, daily and monthly tiers for a database, lowest first"""
+    def __init__(self, db_path, num_sensors, readonly=False):
+        self.hourly = HourlyTier(db_path, num_sensors, readonly)
+        self.daily = DailyTier(db_path, num_sensors, readonly)
+        self.monthly = MonthlyTier(db_path, num_sensors, readonly)
+        self.tiers = [self.hourly, self.daily, self.monthly]
+        self.created = any(tier.created for tier in self.tiers)
+        self.dirty = set() # (sensor, hour) buckets with rows written since the last update
+
+    def __getitem__(self, name):
+        return {tier.name: tier for tier in self.tiers}[name]
+
+    def mark(self, sensor, rownum):
+        # Note that a row was written. The tiers are brought up to date by update().
+        self.dirty.add((sensor, rownum // ROWS_PER_HOUR))
+
+    def update(self, db):
+        # Recompute every bucket affected by rows written since the last update
+        dirty, self.dirty = self.dirty, set()
+        for sensor in sorted({sensor for sensor, _ in dirty}):
+            buckets = numpy.array(sorted(hour for s, hour in dirty if s == sensor), dtype=numpy.int64)
+            for i, tier in enumerate(self.tiers):
+                below = self.tiers[i-1] if i > 0 else None
+                if below is not None:
+                    buckets = numpy.unique(tier.parents(buckets))
+                for bucket in buckets.tolist():
+                    self.recompute(db, tier, below, sensor, bucket)
+
+    def recompute(self, db, tier, below, sensor, bucket):
+        start, end = tier.child_span(bucket)
+        if below is None:
+            temps = db.records(sensor, start, end)
+            temps = temps["temp"][temps["version"] != 0].astype(numpy.int64)
+            low, high, total, count = temps, temps, temps, numpy.ones(len(temps), dtype=numpy.int64)
+        else:
+            children = below.records(sensor, start, end)
+            children = children[children["count"] != 0]
+            low, high = children["low"].astype(numpy.int64), children["high"].astype(numpy.int64)
+            total, count = children["total"].astype(numpy.int64), children["count"].astype(numpy.int64)
+
+        record = tier.records(sensor, bucket, bucket+1)
+        if len(count) == 0:
+            record[0] = (0, 0, 0, 0)
+        else:
+            record[0] = (low.min(), high.max(), total.sum(), count.sum())
+
+    def rebuild(self, db, sensors=None, fresh=False):
+        # Recompute the tiers from the raw records
+        # fresh: the tier files were just created, so there's nothing old to clear
+        if sensors is None: sensors = range(db.count_sensors())
+        for sensor in sensors:
+            if not fresh:
+                self.clear(db, sensor)
+            rownums, records = db.read_arrays(sensor)
+            if len(rownums) == 0:
+                continue
+            temps = records["temp"].astype(numpy.int64)
+            rollup = (rownums, temps, temps, temps, numpy.ones(len(temps), dtype=numpy.int64))
+            for tier in self.tiers:
+                rollup = combine(tier.parents(rollup[0]), *rollup[1:])
+                tier.write(sensor, *rollup)
+        self.dirty = {item for item in self.dirty if item[0] not in sensors}
+
+    def clear(self, db, sensor):
+        # Empty the buckets which cover rows in the occupancy index. No other bucket can hold data.
+        # Only those buckets are read, so untouched parts of the sparse files stay unmapped.
+        for start, end in db.occupancy[sensor].ranges():
+            for tier in self.tiers:
+                start, end = tier.parents(numpy.array([start, end - 1], dtype=numpy.int64)).tolist()
+                end += 1
+                records = tier.records(sensor, start, end)
+                records[numpy.flatnonzero(records["count"])] = 0 # Leaves sparse files sparse
+
+    def close(self):
+        for tier in self.tiers:
+            tier.close()